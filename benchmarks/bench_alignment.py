@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of aligning phrases to spans on long paragraphs.
+
+It builds a document with one long paragraph which refers to figures and
+cites references repeatedly, and measures FigureTagger.tag and
+CiteDetector.detect_cite on it.
+
+Usage:
+    bench_alignment.py [options]
+    bench_alignment.py -h | --help
+
+Options:
+    -h, --help             Show this screen and exit.
+    -r N, --repeat=N       Repeat each stage N times [default: 5].
+    -w N, --words=N        Put N words in the paragraph [default: 20000].
+
+"""
+
+# libraries
+import io
+import sys
+import time
+from pathlib import Path
+from docopt import docopt
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from postprocess.structures import Document
+from postprocess.figuretagger import FigureTagger
+from postprocess.citedetector import CiteDetector
+
+FIGURES = 10
+
+
+def make_document(n_words):
+    """Make a XHTML with a long paragraph of n_words words."""
+    words = []
+    while len(words) < n_words:
+        i = len(words)
+        words += ['the', 'model', 'in', 'Figure', str(i % FIGURES + 1)]
+        words += ['as', 'in', 'Smith', 'et', 'al', '.', '(', '2005', ')']
+
+    spans = ''.join('<span id="w-{}">{}</span>'.format(i, w)
+                    for i, w in enumerate(words))
+    figures = ''.join(
+        '<p id="p-f{0}" data-fig="Figure_{0}" data-text="Figure {0}"/>'.format(
+            i + 1) for i in range(FIGURES))
+
+    xhtml = ('<html xmlns="http://www.w3.org/1999/xhtml">'
+             '<head><meta docid="bench"/></head><body><div>'
+             '<div data-name="Body"><p id="p-1" data-text="{}">{}</p></div>'
+             '<div data-name="Figure">{}</div>'
+             '<div data-name="Reference"><p id="p-2" data-text="Smith, J.: '
+             'Things. (2005)"/></div>'
+             '</div></body></html>').format(' '.join(words), spans, figures)
+
+    return xhtml.encode('utf-8')
+
+
+def measure(xhtml, stage, repeat):
+    """Run the stage on fresh documents and return the best time."""
+    times = []
+    for _ in range(repeat):
+        doc = Document(io.BytesIO(xhtml))
+        start = time.perf_counter()
+        stage(doc)
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+
+def detect_cite(doc):
+    citedetector = CiteDetector()
+    citedetector.open(doc)
+    citedetector.detect_cite()
+
+
+def main():
+    args = docopt(__doc__)
+    repeat = int(args['--repeat'])
+    xhtml = make_document(int(args['--words']))
+
+    print('\t'.join(['stage', 'time [s]']))
+    print('FigureTagger.tag\t{:.4f}'.format(
+        measure(xhtml, FigureTagger().tag, repeat)))
+    print('CiteDetector.detect_cite\t{:.4f}'.format(
+        measure(xhtml, detect_cite, repeat)))
+
+
+if __name__ == '__main__':
+    main()
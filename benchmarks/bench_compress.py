@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the compressed inputs and outputs.
+
+For each compression method, it measures the time of parsing the compressed
+inputs and of writing the compressed results, and the sizes of them. The
+files are read from and written to the page cache, so the times are those
+of the CPU. As the benefit of the compression depends on the storage, the
+time including the transfer of the bytes is estimated for the bandwidths,
+e.g., about 150 MB/sec for a spinning disk and 10 MB/sec for a network
+storage.
+
+Usage:
+    bench_compress.py [options] [XHTML...]
+    bench_compress.py -h | --help
+
+Options:
+    -h, --help             Show this screen and exit.
+    -r N, --repeat=N       Repeat the measurement N times [default: 3].
+    -n N, --docs=N         Generate N synthetic documents, if no XHTML is
+                           given [default: 10].
+    --sections=N           Put N sections in a document [default: 4].
+    --paragraphs=N         Put N paragraphs in a section [default: 6].
+    --words=N              Put N words in a paragraph [default: 80].
+    --bandwidth=LIST       Estimate the time for the bandwidths in MB/sec,
+                           separated by commas [default: 150,50,10].
+
+"""
+
+# libraries
+import sys
+import time
+import shutil
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from docopt import docopt
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from postprocess.structures import Document
+from postprocess.pipeline import get_pipeline, output
+from postprocess.compression import METHODS, check, open_file
+
+from synthetic import generate
+
+
+def best_time(func, repeat):
+    """Call the function repeatedly, and return the best time."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def total_size(files):
+    """The total size of the files in MB."""
+    return sum(fn.stat().st_size for fn in files) / 1024 / 1024
+
+
+def measure(files, docs, method, tmp, repeat):
+    """Measure the parsing and the output with the compression method.
+
+    Returns:
+        A tuple (input size, parse time, output size, output time).
+    """
+    in_dir = tmp / 'in-{}'.format(method)
+    out_dir = tmp / 'out-{}'.format(method)
+    in_dir.mkdir()
+
+    # compress the inputs
+    inputs = []
+    for fn in files:
+        path = in_dir / (fn.name + ('.' + method if method else ''))
+        with open(str(fn), 'rb') as src, open_file(path, 'wb',
+                                                   method) as dst:
+            shutil.copyfileobj(src, dst)
+        inputs.append(path)
+
+    parse = best_time(lambda: [Document(str(fn)) for fn in inputs], repeat)
+    write = best_time(lambda: [output(doc, out_dir, method) for doc in docs],
+                      repeat)
+
+    return (total_size(inputs), parse, total_size(out_dir.iterdir()), write)
+
+
+def main():
+    args = docopt(__doc__)
+    try:
+        repeat = int(args['--repeat'])
+        params = {
+            'sections': int(args['--sections']),
+            'paragraphs': int(args['--paragraphs']),
+            'words': int(args['--words']),
+        }
+        n_docs = int(args['--docs'])
+        bandwidths = [float(b) for b in args['--bandwidth'].split(',')]
+    except ValueError:
+        exit('Invalid number in the options')
+
+    methods = [None]
+    for method in METHODS:
+        try:
+            check(method)
+            methods.append(method)
+        except ValueError as e:
+            print('Skipping {}: {}'.format(method, e))
+
+    with TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        files = [Path(fn) for fn in args['XHTML']]
+        if not files:
+            for seed in range(n_docs):
+                fn = tmp / 'doc-{}.xhtml'.format(seed)
+                fn.write_bytes(generate(seed=seed, **params))
+                files.append(fn)
+
+        # process the documents once; only the output is measured
+        pipeline = get_pipeline()
+        docs = []
+        for fn in files:
+            doc = Document(str(fn))
+            pipeline.run(doc)
+            docs.append(doc)
+
+        results = [(method, measure(files, docs, method, tmp, repeat))
+                   for method in methods]
+
+    print('{} docs'.format(len(files)))
+    print('\t'.join(
+        ['method', 'input [MB]', 'parse [s]', 'output [MB]', 'write [s]'] +
+        ['total at {:g} MB/s [s]'.format(b) for b in bandwidths]))
+
+    for method, (in_size, parse, out_size, write) in results:
+        totals = [parse + write + (in_size + out_size) / b for b in bandwidths]
+        print('\t'.join([method or 'none'] + [
+            '{:.3f}'.format(v)
+            for v in [in_size, parse, out_size, write] + totals
+        ]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Benchmark of MathTagger.tag.
+
+Usage:
+    bench_mathtagger.py [options] XHTML...
+    bench_mathtagger.py -h | --help
+
+Options:
+    -h, --help             Show this screen and exit.
+    -m FILE, --model=FILE  Use FILE as model file.
+    -r N, --repeat=N       Repeat tagging N times [default: 5].
+
+"""
+
+# libraries
+import sys
+import time
+from pathlib import Path
+from docopt import docopt
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from postprocess.config import MODEL_FILE
+from postprocess.structures import Document
+from postprocess.mathtagger import MathTagger
+
+
+def main():
+    args = docopt(__doc__)
+    repeat = int(args['--repeat'])
+    mathtagger = MathTagger(args['--model'] or MODEL_FILE, force=True)
+    mathtagger.load()
+
+    print('\t'.join(['file', 'words', 'tags', 'open [s]', 'tag [s]']))
+    for fn in args['XHTML']:
+        doc = Document(fn)
+
+        start = time.perf_counter()
+        mathtagger.open(doc)
+        opened = time.perf_counter() - start
+
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            total = mathtagger.tag()
+            times.append(time.perf_counter() - start)
+
+        words = sum(len(p['words']) for p in mathtagger.feature_list)
+        print('{}\t{}\t{}\t{:.4f}\t{:.4f}'.format(
+            Path(fn).name, words, total, opened, min(times)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the memory used by Textualizer.textualize.
+
+It generates a large synthetic document (about 500 pages by default) with
+synthetic.py, and textualizes it in a fresh process. The growth of the peak
+RSS over the RSS after parsing is reported (Linux only).
+
+Usage:
+    bench_memory.py [options]
+    bench_memory.py --measure=XHTML
+    bench_memory.py -h | --help
+
+Options:
+    -h, --help             Show this screen and exit.
+    --measure=XHTML        Textualize XHTML only, and print the results.
+    --sections=N           Put N sections [default: 170].
+    --paragraphs=N         Put N paragraphs in each section [default: 10].
+    --words=N              Put N words in each paragraph [default: 150].
+
+"""
+
+# libraries
+import os
+import sys
+import time
+import resource
+import subprocess
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from docopt import docopt
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from postprocess.structures import Document
+from postprocess.textualizer import Textualizer
+
+from synthetic import generate
+
+
+def current_rss():
+    """The current RSS in KiB (Linux only)."""
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+
+    return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+def measure(fn):
+    """Textualize the file, and print 'pages words growth elapsed'."""
+    doc = Document(fn)
+    pages = max(int(p.node.get('data-page')) for p in doc.layout.paragraphs)
+    textualizer = Textualizer()
+    base = current_rss()
+
+    start = time.perf_counter()
+    textualizer.textualize(doc)
+    elapsed = time.perf_counter() - start
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(pages, len(doc.words), max(peak - base, 0), elapsed)
+
+
+def main():
+    args = docopt(__doc__)
+    if args['--measure']:
+        measure(args['--measure'])
+        return
+
+    try:
+        params = {
+            'sections': int(args['--sections']),
+            'paragraphs': int(args['--paragraphs']),
+            'words': int(args['--words']),
+        }
+    except ValueError:
+        exit('Invalid number in the options')
+
+    with TemporaryDirectory() as tmp:
+        fn = os.path.join(tmp, 'doc.xhtml')
+        Path(fn).write_bytes(generate(**params))
+
+        res = subprocess.run(
+            [sys.executable, __file__, '--measure=' + fn],
+            stdout=subprocess.PIPE, check=True, universal_newlines=True)
+        pages, words, growth, elapsed = res.stdout.split()
+
+    print('\t'.join(['pages', 'words', 'peak growth [KiB]', 'time [s]']))
+    print('{}\t{}\t{}\t{:.3f}'.format(pages, words, growth, float(elapsed)))
+
+
+if __name__ == '__main__':
+    main()
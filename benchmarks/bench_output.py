@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the peak memory in serializing XHTML.
+
+For each file, it compares the streaming writer (Document.write) with
+building the whole serialization by etree.tostring. Each measurement runs
+in a fresh process, and the growth of the peak RSS over the RSS after
+parsing is reported.
+
+Usage:
+    bench_output.py [options] XHTML...
+    bench_output.py --measure=METHOD XHTML
+    bench_output.py -h | --help
+
+Options:
+    -h, --help             Show this screen and exit.
+    --measure=METHOD       Measure METHOD ('write' or 'tostring') only.
+
+"""
+
+# libraries
+import os
+import sys
+import time
+import resource
+import subprocess
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from docopt import docopt
+from lxml import etree
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from postprocess.structures import Document
+
+
+def current_rss():
+    """The current RSS in KiB (Linux only)."""
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+
+    return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+def measure(method, fn):
+    """Serialize the file with the method, and print 'growth elapsed'."""
+    doc = Document(fn)
+    base = current_rss()
+
+    with TemporaryDirectory() as tmp:
+        out = os.path.join(tmp, 'out.xhtml')
+        start = time.perf_counter()
+        if method == 'write':
+            doc.write(out)
+        else:
+            Path(out).write_bytes(etree.tostring(doc.tree))
+        elapsed = time.perf_counter() - start
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(max(peak - base, 0), elapsed)
+
+
+def main():
+    args = docopt(__doc__)
+    if args['--measure']:
+        measure(args['--measure'], args['XHTML'][0])
+        return
+
+    print('\t'.join(['file', 'size [KiB]', 'method', 'peak growth [KiB]',
+                     'time [s]']))
+    for fn in args['XHTML']:
+        size = os.path.getsize(fn) // 1024
+        for method in ('tostring', 'write'):
+            res = subprocess.run(
+                [sys.executable, __file__, '--measure=' + method, fn],
+                stdout=subprocess.PIPE, check=True, universal_newlines=True)
+            growth, elapsed = res.stdout.split()
+            print('{}\t{}\t{}\t{}\t{:.3f}'.format(
+                Path(fn).name, size, method, growth, float(elapsed)))
+
+
+if __name__ == '__main__':
+    main()
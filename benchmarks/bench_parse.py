@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Benchmark of parsing XHTML with the parsers in PARSER_OPTIONS.
+
+It parses the XHTML files (or synthetic documents made by synthetic.py) with
+each parser as Document does, and reports the best time of the repetitions,
+the throughput (MB/sec and docs/sec) and the speedup over the default parser
+of lxml. It also checks whether the serialized trees are the same as those
+of the default parser.
+
+Usage:
+    bench_parse.py [options] [XHTML...]
+    bench_parse.py -h | --help
+
+Options:
+    -h, --help             Show this screen and exit.
+    -r N, --repeat=N       Repeat the parsing N times [default: 5].
+    -n N, --docs=N         Generate N synthetic documents, if no XHTML is
+                           given [default: 10].
+    --sections=N           Put N sections in a document [default: 8].
+    --paragraphs=N         Put N paragraphs in a section [default: 10].
+    --words=N              Put N words in a paragraph [default: 100].
+
+"""
+
+# libraries
+import sys
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from docopt import docopt
+from lxml import etree
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from postprocess.structures import PARSER_OPTIONS, Document, get_parser
+
+from synthetic import generate
+
+
+def measure(files, name, repeat):
+    """Parse the files repeatedly with the parser.
+
+    Returns:
+        A tuple (elapsed, trees), where elapsed is the best time to parse all
+        files, and trees is the list of the serialized trees.
+    """
+    parser = get_parser(name)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        docs = [Document(str(fn), parser) for fn in files]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, [etree.tostring(doc.tree) for doc in docs]
+
+
+def main():
+    args = docopt(__doc__)
+    try:
+        repeat = int(args['--repeat'])
+        params = {
+            'sections': int(args['--sections']),
+            'paragraphs': int(args['--paragraphs']),
+            'words': int(args['--words']),
+        }
+        n_docs = int(args['--docs'])
+    except ValueError:
+        exit('Invalid number in the options')
+
+    with TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        files = [Path(fn) for fn in args['XHTML']]
+        if not files:
+            for seed in range(n_docs):
+                fn = tmp / 'doc-{}.xhtml'.format(seed)
+                fn.write_bytes(generate(seed=seed, **params))
+                files.append(fn)
+
+        size = sum(fn.stat().st_size for fn in files) / 1024 / 1024
+        results = {
+            name: measure(files, name, repeat)
+            for name in PARSER_OPTIONS
+        }
+
+    print('{} docs, {:.1f} MB'.format(len(files), size))
+    print('\t'.join(['parser', 'time [s]', 'MB/sec', 'docs/sec', 'speedup',
+                     'same trees']))
+
+    base, base_trees = results['default']
+    for name, (elapsed, trees) in results.items():
+        print('{}\t{:.4f}\t{:.1f}\t{:.1f}\t{:.2f}\t{}'.format(
+            name, elapsed, size / elapsed, len(files) / elapsed,
+            base / elapsed, 'yes' if trees == base_trees else 'no'))
+
+
+if __name__ == '__main__':
+    main()
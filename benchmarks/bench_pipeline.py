@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the stages and the whole pipeline.
+
+It processes the XHTML files (or synthetic documents made by synthetic.py)
+with the pipeline, and reports the time, the throughput (words/sec and
+docs/sec) of each stage and of the whole pipeline, and the peak memory.
+The times are taken from the stats of the documents, and the best run of
+the repetitions is reported.
+
+The results can be saved as JSON, and compared with saved results to catch
+regressions: stages slower than the saved ones by more than the tolerance
+are reported, and the exit status becomes 1.
+
+Usage:
+    bench_pipeline.py [options] [XHTML...]
+    bench_pipeline.py -h | --help
+
+Options:
+    -h, --help             Show this screen and exit.
+    -r N, --repeat=N       Repeat the run N times [default: 3].
+    -n N, --docs=N         Generate N synthetic documents, if no XHTML is
+                           given [default: 10].
+    --sections=N           Put N sections in a document [default: 4].
+    --paragraphs=N         Put N paragraphs in a section [default: 6].
+    --words=N              Put N words in a paragraph [default: 80].
+    --math=RATIO           Ratio of math runs in the words [default: 0.1].
+    --references=N         Put N references in a document [default: 20].
+    --figures=N            Put N figures in a document [default: 3].
+    --save=FILE            Save the results to FILE as JSON.
+    --compare=FILE         Compare the results with FILE saved by --save.
+    --tolerance=PCT        Report the stages slower than the saved results
+                           by more than PCT percent [default: 20].
+
+"""
+
+# libraries
+import sys
+import json
+import time
+import resource
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from docopt import docopt
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from postprocess.structures import Document
+from postprocess.pipeline import get_pipeline, output
+from postprocess.instrument import Report
+
+from synthetic import generate
+
+STAGES = ['parse', 'figure', 'math', 'cite', 'text', 'output']
+
+
+def run(files, out_dir):
+    """Process the files once.
+
+    Returns:
+        A tuple (report, elapsed), where report is the Report of the
+        documents and elapsed is the wall time of the whole run.
+    """
+    pipeline = get_pipeline()
+    report = Report()
+
+    start = time.perf_counter()
+    for fn in files:
+        doc = Document(str(fn))
+        pipeline.run(doc)
+        with doc.stats.stage('output'):
+            output(doc, out_dir)
+        report.add(fn, 'done', doc.stats.to_dict())
+
+    return report, time.perf_counter() - start
+
+
+def measure(files, out_dir, repeat):
+    """Run the files repeatedly, and take the best time of each stage.
+
+    Returns:
+        A dictionary of the results.
+    """
+    # load the model in advance
+    get_pipeline()
+
+    best = {}
+    for _ in range(repeat):
+        report, elapsed = run(files, out_dir)
+        totals = {'pipeline': elapsed}
+        for row in report.summary():
+            if row['kind'] == 'wall':
+                totals[row['metric']] = row['total']
+            elif row['kind'] == 'counters' and row['metric'] == 'text.words':
+                words = row['total']
+
+        for stage, t in totals.items():
+            best[stage] = min(t, best.get(stage, t))
+
+    return {
+        'docs': len(files),
+        'words': words,
+        'times': best,
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def print_results(results):
+    docs, words = results['docs'], results['words']
+    print('{} docs, {} words, peak RSS {:.1f} MiB'.format(
+        docs, words, results['peak_rss'] / 1024))
+    print('\t'.join(['stage', 'time [s]', 'words/sec', 'docs/sec']))
+
+    times = results['times']
+    for stage in STAGES + ['pipeline']:
+        t = times.get(stage)
+        if not t:
+            continue
+        print('{}\t{:.4f}\t{:.0f}\t{:.2f}'.format(stage, t, words / t,
+                                                  docs / t))
+
+
+def compare(results, saved, tolerance):
+    """Compare the throughput of the stages with the saved results.
+
+    Returns:
+        The list of the regressed stages.
+    """
+    print('\t'.join(['stage', 'saved [words/sec]', 'now [words/sec]',
+                     'change [%]']))
+
+    regressed = []
+    for stage in STAGES + ['pipeline']:
+        if stage not in results['times'] or stage not in saved['times']:
+            continue
+        now = results['words'] / results['times'][stage]
+        before = saved['words'] / saved['times'][stage]
+        change = (now - before) / before * 100
+        print('{}\t{:.0f}\t{:.0f}\t{:+.1f}'.format(stage, before, now, change))
+        if change < -tolerance:
+            regressed.append(stage)
+
+    return regressed
+
+
+def main():
+    args = docopt(__doc__)
+    try:
+        repeat = int(args['--repeat'])
+        tolerance = float(args['--tolerance'])
+        params = {
+            'sections': int(args['--sections']),
+            'paragraphs': int(args['--paragraphs']),
+            'words': int(args['--words']),
+            'math': float(args['--math']),
+            'references': int(args['--references']),
+            'figures': int(args['--figures']),
+        }
+        n_docs = int(args['--docs'])
+    except ValueError:
+        exit('Invalid number in the options')
+
+    with TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        files = [Path(fn) for fn in args['XHTML']]
+        if not files:
+            for seed in range(n_docs):
+                fn = tmp / 'doc-{}.xhtml'.format(seed)
+                fn.write_bytes(generate(seed=seed, **params))
+                files.append(fn)
+
+        results = measure(files, tmp / 'out', repeat)
+
+    print_results(results)
+
+    if args['--save'] is not None:
+        with open(args['--save'], 'w') as f:
+            json.dump(results, f, indent=1)
+
+    if args['--compare'] is not None:
+        with open(args['--compare']) as f:
+            saved = json.load(f)
+        regressed = compare(results, saved, tolerance)
+        if regressed:
+            print('Regressed: {}'.format(', '.join(regressed)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+Generator of synthetic XHTML in the shape of the outputs of pdfanalyzer.
+
+The documents have the structure which the stages expect:
+
+    html/head/meta/@docid
+    html/head/ftypes/fontspec[@id,@name,@size]
+    html/body/div[@id,@data-name]/div[@data-name]/p[@id,@data-page,@data-text]
+        /span[@class,@id,@data-ftype,@data-space,@data-bdr]
+
+with body sections (Body and Equation boxes), figures and tables with
+captions, and references. The body text refers to the figures and cites the
+references, and contains runs of math words. The same seed always gives the
+same document.
+
+Usage:
+    synthetic.py [options] OUT
+    synthetic.py -h | --help
+
+Options:
+    -h, --help             Show this screen and exit.
+    --seed=N               Use N as the random seed [default: 0].
+    --sections=N           Put N sections [default: 4].
+    --paragraphs=N         Put N paragraphs in each section [default: 6].
+    --words=N              Put N words (at least) in each paragraph
+                           [default: 80].
+    --math=RATIO           Start a run of math words at RATIO of the words
+                           [default: 0.1].
+    --references=N         Put N references [default: 20].
+    --figures=N            Put N figures and N tables [default: 3].
+    --style=STYLE          Cite as 'name' (Smith et al. (2005)) or 'number'
+                           ([3]) [default: name].
+
+"""
+
+# libraries
+import random
+from xml.sax.saxutils import escape, quoteattr
+from docopt import docopt
+
+FONTS = [
+    ('f1', 'CMR10', '9.963pt'),
+    ('f2', 'CMMI10', '9.963pt'),
+    ('f3', 'CMSY10', '9.963pt'),
+    ('f4', 'CMBX12', '14.346pt'),
+    ('f5', 'CMR8', '7.97pt'),
+]
+WORDS = ('the of a we model is in to that for this method our results show '
+         'data using be as which are on by an approach however not can '
+         'based system with two each set use adopt').split()
+SURNAMES = ['Smith', 'Jones', 'Brown', 'Tanaka', 'Suzuki', 'Miller',
+            'Garcia', 'Chen', 'Wang', 'Kim', 'Lopez', 'Martin']
+MATH = ['x', 'y', 'α', 'β', '=', '+', '∑', '(', ')', 'f', '2',
+        'i']
+
+
+class Generator:
+    """Build a synthetic XHTML document."""
+
+    def __init__(self, seed=0, sections=4, paragraphs=6, words=80, math=0.1,
+                 references=20, figures=3, style='name'):
+        self.random = random.Random(seed)
+        self.seed = seed
+        self.sections = sections
+        self.paragraphs = paragraphs
+        self.words = words
+        self.math = math
+        self.figures = figures
+        self.style = style
+
+        self.word_id = 0
+        self.par_id = 0
+        self.page = 1
+        self.references = [(self.random.choice(SURNAMES),
+                            self.random.choice(SURNAMES),
+                            1990 + self.random.randrange(30))
+                           for _ in range(references)]
+
+    def generate(self):
+        """Generate the document.
+
+        Returns:
+            The XHTML string.
+        """
+        body = [self.__title()]
+        body.extend(self.__section(s + 1) for s in range(self.sections))
+        body.extend(self.__figure(f + 1, typ) for f in range(self.figures)
+                    for typ in ('Figure', 'Table'))
+        body.append(self.__references())
+
+        fonts = ''.join('<fontspec id="{}" name="{}" size="{}"/>'.format(*f)
+                        for f in FONTS)
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<html xmlns="http://www.w3.org/1999/xhtml"><head>'
+                '<meta docid="doc-{}"/><ftypes>{}</ftypes></head>'
+                '<body>{}</body></html>').format(
+                    self.seed, fonts, ''.join(body))
+
+    def __span(self, text, ftype, space):
+        self.word_id += 1
+        i = self.word_id
+        x = 50 + (i % 60) * 8
+        y = 50 + (i // 60 % 50) * 12
+        return ('<span class="word" id="w-{}" data-ftype="{}" '
+                'data-space="{}" data-bdr="{},{},{},{}">{}</span>').format(
+                    i, ftype, space, x, y, x + 7, y + 10, escape(text))
+
+    def __paragraph(self, tokens, extra=''):
+        """Make a paragraph of the tokens.
+
+        Args:
+            tokens (list): (text, ftype, spaced) where spaced is whether the
+                token is separated from the previous one by a space.
+            extra (str): Additional attributes of the paragraph.
+        """
+        self.par_id += 1
+        text = ''
+        spans = []
+        for k, (t, ftype, spaced) in enumerate(tokens):
+            if k == 0:
+                space = 'bol'
+            elif spaced:
+                text += ' '
+                space = 'space'
+            else:
+                space = 'nospace'
+            text += t
+            spans.append(self.__span(t, ftype, space))
+
+        return '<p id="p-{}" data-page="{}" data-text={}{}>{}</p>'.format(
+            self.par_id, self.page, quoteattr(text), extra, ''.join(spans))
+
+    def __sentence(self, n):
+        """Make the tokens of a sentence with about n words."""
+        rnd = self.random
+        tokens = []
+        while len(tokens) < n:
+            r = rnd.random()
+            if r < self.math:
+                for _ in range(rnd.randrange(1, 5)):
+                    tokens.append(
+                        (rnd.choice(MATH), rnd.choice(['f2', 'f3']), True))
+
+            elif r < self.math + 0.03 and self.references:
+                if self.style == 'name':
+                    a, _, y = rnd.choice(self.references)
+                    tokens.extend([(a, 'f1', True), ('et', 'f1', True),
+                                   ('al', 'f1', True), ('.', 'f1', False),
+                                   ('(', 'f1', True), (str(y), 'f1', False),
+                                   (')', 'f1', False)])
+                else:
+                    k = rnd.randrange(len(self.references)) + 1
+                    tokens.extend([('[', 'f1', True), (str(k), 'f1', False),
+                                   (']', 'f1', False)])
+
+            elif r < self.math + 0.05 and self.figures:
+                tokens.append((rnd.choice(['Figure', 'Table']), 'f1', True))
+                tokens.append(
+                    (str(rnd.randrange(1, self.figures + 1)), 'f1', True))
+
+            else:
+                tokens.append((rnd.choice(WORDS), 'f1', True))
+
+        tokens.append(('end.', 'f1', True))
+        return tokens
+
+    def __title(self):
+        return ('<div id="s-0" data-name="Title"><div data-name="Title">' +
+                self.__paragraph([('A', 'f4', True), ('Title', 'f4', True)]) +
+                '</div></div>')
+
+    def __section(self, i):
+        pars = []
+        for _ in range(self.paragraphs):
+            tokens = []
+            while len(tokens) < self.words:
+                tokens.extend(self.__sentence(self.random.randrange(8, 25)))
+            pars.append(self.__paragraph(tokens))
+            if self.random.random() < 0.3:
+                self.page += 1
+
+        equation = self.__paragraph(
+            [(self.random.choice(MATH), 'f2', True) for _ in range(7)])
+
+        return ('<div id="s-{}" data-name="Section">'
+                '<div data-name="Body">{}</div>'
+                '<div data-name="Equation">{}</div></div>').format(
+                    i, ''.join(pars), equation)
+
+    def __figure(self, i, typ):
+        figure = self.__paragraph(
+            [('img', 'f1', True)], ' data-fig="{}_{}"'.format(typ, i))
+        caption = self.__paragraph([(typ, 'f1', True),
+                                    ('{}:'.format(i), 'f1', True),
+                                    ('caption', 'f1', True)])
+
+        return ('<div id="s-{0}{1}" data-name="{0}"><div data-name="{0}">'
+                '{2}</div><div data-name="Caption">{3}</div></div>').format(
+                    typ, i, figure, caption)
+
+    def __references(self):
+        pars = []
+        for k, (a, b, y) in enumerate(self.references):
+            if self.style == 'name':
+                words = [a + ',', 'J.,', b + ',', 'K.:', 'A', 'study', 'of',
+                         'things.', '({})'.format(y)]
+            else:
+                words = ['[{}]'.format(k + 1), a + ',', 'J.:', 'Things.',
+                         str(y)]
+            pars.append(self.__paragraph([(w, 'f5', True) for w in words]))
+
+        return ('<div id="s-r" data-name="References">'
+                '<div data-name="Reference">{}</div></div>').format(
+                    ''.join(pars))
+
+
+def generate(**kwargs):
+    """Generate a synthetic XHTML document.
+
+    Args:
+        kwargs: The parameters of Generator.
+
+    Returns:
+        The XHTML as bytes.
+    """
+    return Generator(**kwargs).generate().encode('utf-8')
+
+
+def main():
+    args = docopt(__doc__)
+    try:
+        kwargs = {
+            'seed': int(args['--seed']),
+            'sections': int(args['--sections']),
+            'paragraphs': int(args['--paragraphs']),
+            'words': int(args['--words']),
+            'math': float(args['--math']),
+            'references': int(args['--references']),
+            'figures': int(args['--figures']),
+        }
+    except ValueError:
+        exit('Invalid number in the options')
+    if args['--style'] not in ('name', 'number'):
+        exit('Unknown style: {}'.format(args['--style']))
+
+    with open(args['OUT'], 'wb') as f:
+        f.write(generate(style=args['--style'], **kwargs))
+
+
+if __name__ == '__main__':
+    main()
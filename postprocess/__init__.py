@@ -1,2 +1,4 @@
 # package declaration
-__all__ = ['structures', 'textualizer', 'mathtagger', 'figuretagger', 'citedetector']
+__all__ = ['structures', 'textualizer', 'mathtagger', 'figuretagger', 'citedetector',
+           'pipeline', 'cache', 'instrument', 'server', 'stream', 'compression',
+           'archive', 'database']
@@ -2,36 +2,76 @@
 
 # libraries
 import re
-import csv
+import os
+import sys
+import time
+import multiprocessing
 from pathlib import Path
 from docopt import docopt
-from lxml import etree
 
-from .config import PKG_NAME, VERSION
-from .exceptions import AlreadyTaggedError
+from .config import PKG_NAME, VERSION, MODEL_FILE, CACHE_DIR
 from .cli_utils import set_logger
-from .structures import Document
-from .figuretagger import FigureTagger
-from .mathtagger import MathTagger
-from .citedetector import CiteDetector
-from .textualizer import Textualizer
+from .structures import set_parser
+from .compression import check
+from .pipeline import get_pipeline, process_file
+from .archive import get_archive
+from .database import get_database
+from .cache import ResultCache
+from .instrument import Report
+from .server import serve
 
 # help text
 HELP = """
 The postprocess script for PDFNLT.
 
 Usage:
+    {p} serve [options]
     {p} [options] XHTML...
     {p} -h | --help
     {p} -V | --version
 
 Options:
+    -a, --archive        Append the results into tar shards in the output
+                         DIR, with the index of the offsets (index.tsv),
+                         instead of the files; the cache and -i are not
+                         used.
     -b, --batch          Execute with batch mode.
+    --cache-dir=DIR      Cache the results in DIR.
+    --cache-size=MB      Evict the least recently used results when the
+                         cache exceeds MB megabytes [default: 10240].
+    --cache-age=DAYS     Evict the results unused for DAYS days
+                         [default: 30].
+    --compress=METHOD    Compress the result files with METHOD: gz, xz or
+                         zst (needs the zstandard package).
+    --database=FILE      Write the words, the sentences, the maths and the
+                         cites into the SQLite database FILE instead of the
+                         TSV files; the cache and -i are not used.
     -h, --help           Show this screen and exit.
+    --host=HOST          Serve on HOST [default: 127.0.0.1].
+    -i, --incremental    Process only the files whose results are older
+                         than the input or the model file.
+    -j N, --jobs=N       Process N files in parallel; 0 means the number
+                         of CPUs [default: 1].
     -l FILE, --log=FILE  Output messages to FILE.
     -m, --map            Insert positions into the xhtml.
+    --no-cache           Do not use nor update the cache.
     -o DIR, --out=DIR    Output files to DIR.
+    -p N, --port=N       Serve on the port N [default: 8000].
+    --parser=NAME        Parse the XHTML with the parser NAME: 'tuned',
+                         'compact' (also removes the whitespaces between
+                         the elements) or 'default' (the default parser of
+                         lxml) [default: tuned].
     -q, --quiet          Show less messages.
+    --rebuild            Process all files even if cached, and update
+                         the cache.
+    --socket=PATH        Serve on the UNIX socket PATH instead of the port.
+    -s, --stream         Read the XHTML section by section to save memory
+                         for very large files.
+    --shard-size=N       Start a new shard of the archive after N
+                         documents [default: 1000].
+    --stats=FILE         Write the timings and the counters of the stages
+                         to FILE (JSON if FILE ends with .json, otherwise
+                         TSV).
     -v, --verbose        Show more messages.
     -V, --version        Show version.
 
@@ -43,75 +83,44 @@ logger = log.getLogger('postprocess')
 
 
 # the application
-def output(doc, out_dir):
-    """Output the result files."""
-
-    # general preparation
-    logger.debug('Outputting the results into {}'.format(out_dir))
-    out_dir.mkdir(parents=True, exist_ok=True)
-    src = Path(doc.filename)
-
-    def get_writer(f):
-        return csv.writer(
-            f,
-            delimiter='\t',
-            quotechar='"',
-            lineterminator='\n',
-            quoting=csv.QUOTE_MINIMAL)
-
-    # word.tsv
-    word_tsv = out_dir / Path(src.stem + '.word.tsv')
-    logger.debug('Writing {}'.format(word_tsv))
-
-    with open(str(word_tsv), 'w', newline='') as f:
-        writer = get_writer(f)
-        writer.writerow(['ID', 'From', 'To', src])
-        for w in doc.words:
-            writer.writerow(w)
-
-    # xhtml
-    xhtml = out_dir / Path(src.name)
-    logger.debug('Writing {}'.format(xhtml))
-    xhtml.write_bytes(etree.tostring(doc.tree))
-
-    # plain text
-    txt = out_dir / Path(src.stem + '.txt')
-    logger.debug('Writing {}'.format(txt))
-    txt.write_text(doc.text, encoding='utf-8')
-
-    # sent.tsv
-    sent_tsv = out_dir / Path(src.stem + '.sent.tsv')
-    logger.debug('Writing {}'.format(sent_tsv))
-
-    with open(str(sent_tsv), 'w', newline='') as f:
-        writer = get_writer(f)
-        writer.writerow(['id', 'sect_name', 'box_name', 'text', 'words'])
-        for s in doc.sentences:
-            writer.writerow([
-                s._id, s.sec_name, s.box_name,
-                s.text.strip(), ','.join(s.words)
-            ])
-
-    # math.tsv
-    math_tsv = out_dir / Path(src.stem + '.math.tsv')
-    logger.debug('Writing {}'.format(math_tsv))
-
-    with open(str(math_tsv), 'w', newline='') as f:
-        writer = get_writer(f)
-        writer.writerow(
-            ['MathID', 'StartID', 'EndId', 'Page', 'X1', 'Y1', 'X2', 'Y2'])
-        for m in doc.maths:
-            writer.writerow(m)
-
-    # cite.tsv
-    cite_tsv = out_dir / Path(src.stem + '.cite.tsv')
-    logger.debug('Writing {}'.format(cite_tsv))
-
-    with open(str(cite_tsv), 'w', newline='') as f:
-        writer = get_writer(f)
-        writer.writerow(['CiteID', 'Text', 'From'])
-        for c in doc.cites:
-            writer.writerow([c[0], c[1], ','.join(c[2])])
+def run_task(task):
+    """Process a file, continuing on errors in batch mode.
+
+    This is the unit of work for both the sequential and the parallel modes.
+
+    Args:
+        task (tuple): (fn, out_dir, remove_pos, batch_mode, cache,
+            incremental, stream, compress, archive, database)
+
+    Returns:
+        A tuple (fn, status, stats), where status is 'done', 'skipped' or
+        'failed', and stats is the dictionary of the timings and the
+        counters of the processed document (otherwise None).
+    """
+    (fn, out_dir, remove_pos, batch_mode, cache, incremental, stream,
+     compress, archive, database) = task
+
+    # try to process the file
+    try:
+        doc = process_file(fn, out_dir, remove_pos, cache, incremental,
+                           stream, compress, archive, database)
+        if doc is None:
+            return fn, 'skipped', None
+
+    except Exception as e:
+        logger.exception('Failed to process "{}"'.format(fn))
+
+        # in batch mode, just report the error and continue
+        if batch_mode:
+            logger.warn(
+                'We got an error, but continuing the process (batch mode)')
+            return fn, 'failed', None
+
+        # otherwise, raise the error
+        else:
+            raise
+
+    return fn, 'done', doc.stats.to_dict()
 
 
 def main():
@@ -119,7 +128,9 @@ def main():
 
     1. parse command line options
     2. setup the logger
-    3. treat all input xhtml
+    3. treat all input xhtml, in parallel if requested, or serve the jobs
+       in the server mode
+    4. report the summary and the stats
     """
     # parse options and arguments
     args = docopt(HELP, version=VERSION)
@@ -152,58 +163,114 @@ def main():
     else:
         out_dir = Path(args['--out'])
 
-    for fn in args['XHTML']:
-        # initialize
-        fn = Path(fn)
-        logger.info('Begin to process: {}'.format(fn))
-
-        textualizer = Textualizer()
-        citedetector = CiteDetector()
-        figuretagger = FigureTagger()
-
-        model_file = 'postprocess/mathtagger/model/inline_math.model'
-        mathtagger = MathTagger(model_file)
-
-        # try to process the file
-        try:
-            # load the xhtml
-            doc = Document(str(fn))
-
-            # figure tagging
-            figuretagger.tag(doc)
-
-            # math tagging
-            mathtagger.open(doc)
-
-            try:
-                mathtagger.tag()
-
-            except AlreadyTaggedError:
-                logger.warn(
-                    'mathtagger: File "{}" is already math-tagged. Skipping'.
-                    format(fn))
-
-            # citation detection
-            citedetector.open(doc)
-            citedetector.detect_cite()
-
-            # textualize
-            textualizer.textualize(doc, remove_pos)
-
-            # output the results
-            output(doc, out_dir)
-
-        except Exception as e:
-            logger.exception('Failed to process "{}"'.format(fn))
-
-            # in batch mode, just report the error and continue
-            if batch_mode:
-                logger.warn(
-                    'We got an error, but continuing the process (batch mode)')
-
-            # otherwise, raise the error
-            else:
-                raise
+    # the parser and the compression of the results
+    compress = args['--compress']
+    try:
+        set_parser(args['--parser'])
+        if compress is not None:
+            check(compress)
+    except ValueError as e:
+        logger.error(e)
+        sys.exit(1)
+
+    # the number of worker processes
+    try:
+        jobs = int(args['--jobs'])
+        port = int(args['--port'])
+        cache_size = float(args['--cache-size']) * 1024 * 1024
+        cache_age = float(args['--cache-age']) * 24 * 60 * 60
+        shard_size = int(args['--shard-size'])
+    except ValueError:
+        logger.error('Invalid number in the options')
+        sys.exit(1)
+    if shard_size <= 0:
+        logger.error('Invalid shard size: {}'.format(shard_size))
+        sys.exit(1)
+    if jobs <= 0:
+        jobs = os.cpu_count() or 1
+
+    # the result cache
+    if args['--no-cache']:
+        cache = None
+        logger.debug('The cache is disabled')
+    else:
+        cache_dir = args['--cache-dir'] or CACHE_DIR
+        cache = ResultCache(cache_dir, MODEL_FILE, args['--rebuild'])
+        logger.debug('Using the cache: {}'.format(cache_dir))
+
+    # the server mode
+    if args['serve']:
+        serve(out_dir, args['--host'], port, args['--socket'], jobs, cache,
+              compress, cache_size, cache_age)
+        return
+
+    # load the stages and the model once; the workers inherit them
+    get_pipeline()
+
+    jobs = min(jobs, len(args['XHTML']))
+    files = [Path(fn) for fn in args['XHTML']]
+    incremental = args['--incremental']
+    stream = args['--stream']
+
+    # the archive; the index is created before forking the workers
+    archive = None
+    if args['--archive']:
+        archive = shard_size
+        get_archive(out_dir, shard_size)
+
+    # the database; the tables are created before forking the workers
+    database = args['--database']
+    if database is not None:
+        get_database(database)
+
+    # the results are not files in out_dir, so the cache is not used nor
+    # evicted
+    if archive is not None or database is not None:
+        if incremental:
+            logger.warning('-i is not used with the archive nor the database')
+        if cache is not None:
+            logger.debug('The cache is not used with the archive nor the '
+                         'database')
+            cache = None
+
+    tasks = [(fn, out_dir, remove_pos, batch_mode, cache, incremental, stream,
+              compress, archive, database) for fn in files]
+    statuses = {'done': [], 'skipped': [], 'failed': []}
+    report = Report()
+    start = time.perf_counter()
+
+    if jobs > 1:
+        logger.debug('Using {} worker processes'.format(jobs))
+
+        # fork keeps the logger settings and the loaded model in the workers
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(jobs) as pool:
+            for fn, status, stats in pool.imap_unordered(run_task, tasks):
+                statuses[status].append(fn)
+                report.add(fn, status, stats)
+    else:
+        for task in tasks:
+            fn, status, stats = run_task(task)
+            statuses[status].append(fn)
+            report.add(fn, status, stats)
+
+    # report the summary
+    elapsed = time.perf_counter() - start
+    logger.info('Processed {} files in {:.2f} sec ({:.2f} files/sec): '
+                '{} succeeded, {} skipped, {} failed'.format(
+                    len(files), elapsed, len(files) / elapsed if elapsed else 0,
+                    len(statuses['done']), len(statuses['skipped']),
+                    len(statuses['failed'])))
+    for fn in statuses['failed']:
+        logger.warning('Failed: {}'.format(fn))
+
+    if args['--stats'] is not None:
+        logger.info('Writing the stats to {}'.format(args['--stats']))
+        report.dump(args['--stats'])
+
+    # keep the cache within the limits
+    if cache is not None:
+        cache.evict(cache_size, cache_age)
 
 
 # execute
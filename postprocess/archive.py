@@ -0,0 +1,263 @@
+"""
+The archive output.
+
+Instead of six result files per document in the output directory, the
+results can be appended into a few archives (shards). Each process writes
+its own shards, named shard-<pid>-<n>.tar, and starts a new shard after
+every shard_size documents. The result files of a document are the members
+of a shard, named as in the output directory (e.g., paper.word.tsv.gz if
+compressed), so a shard can be extracted with tar.
+
+The index (index.tsv) maps each document to the offsets of its results:
+
+    Document    Kind        Shard                   Offset  Size
+    paper       word.tsv    shard-1234-0001.tar     512     10240
+
+where Offset and Size are those of the data of the member in the shard, so
+the readers can seek directly to the results of a document (see
+ArchiveReader). The index and the shards are append-only; a document
+processed again is appended, and its last entries win.
+
+A shard is a complete tar after each document; the results of a document
+are listed in the index only after they are written and flushed.
+"""
+
+# libraries
+import io
+import os
+import csv
+import time
+import tarfile
+from contextlib import contextmanager
+from pathlib import Path
+
+from .compression import open_file
+
+# the name of the index file
+INDEX_FILE = 'index.tsv'
+
+# the columns of the index
+INDEX_HEADER = ['Document', 'Kind', 'Shard', 'Offset', 'Size']
+
+
+# the module
+class MemberFile(io.RawIOBase):
+    """The data of a member, written through into the shard."""
+
+    def __init__(self, f):
+        self.f = f
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        n = memoryview(b).nbytes
+        self.f.write(b)
+        self.size += n
+        return n
+
+
+class ArchiveWriter:
+    """Append the results of the documents into the shards.
+
+    Use get_archive() to get the writer shared in the process; a writer
+    inherited by a forked worker opens the shards of its own.
+    """
+
+    def __init__(self, out_dir, shard_size=1000):
+        """Initialize the writer, and create the index if missing.
+
+        Args:
+            out_dir (Path): The output directory
+            shard_size (int): The number of documents in a shard
+        """
+        self.out_dir = Path(str(out_dir))
+        self.shard_size = shard_size
+        self.index = self.out_dir / INDEX_FILE
+        self.pid = os.getpid()
+        self.file = None
+        self.shard = None
+        self.seq = 0
+        self.n_docs = 0
+        self.end = 0
+        self.document = None
+        self.members = []
+
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            with open(str(self.index), 'x', newline='') as f:
+                csv.writer(f, delimiter='\t', lineterminator='\n').writerow(
+                    INDEX_HEADER)
+        except FileExistsError:
+            pass
+
+    def begin(self, document):
+        """Begin to write the results of the document.
+
+        The members written but not committed (e.g., by a failed document)
+        are overwritten.
+        """
+        # a forked worker writes its own shards
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.file = None
+            self.seq = 0
+
+        if self.file is None:
+            self.__open_shard()
+
+        self.file.seek(self.end)
+        self.document = document
+        self.members = []
+
+    @contextmanager
+    def open(self, kind, name, mode='wb', method=None, **kwargs):
+        """Open a member of the document to write, as open_file does.
+
+        Args:
+            kind (str): The kind of the result, e.g., 'word.tsv'
+            name (str): The name of the member
+            mode (str): 'wb' or 'wt'
+            method (str): The compression method, or None
+            kwargs: Passed to the opener, e.g., encoding and newline
+        """
+        info = tarfile.TarInfo(name)
+        info.mtime = int(time.time())
+        info.mode = 0o644
+
+        start = self.file.tell()
+        header = self.__header(info)
+        self.file.write(header)
+
+        raw = MemberFile(self.file)
+        if method is not None:
+            f = open_file(raw, mode, method, **kwargs)
+        elif 'b' in mode:
+            f = io.BufferedWriter(raw)
+        else:
+            f = io.TextIOWrapper(io.BufferedWriter(raw), **kwargs)
+
+        with f:
+            yield f
+
+        # pad the data, and fix the size in the header
+        self.file.write(bytes(-raw.size % tarfile.BLOCKSIZE))
+        end = self.file.tell()
+        info.size = raw.size
+        self.file.seek(start)
+        self.file.write(self.__header(info))
+        self.file.seek(end)
+
+        self.members.append((kind, start + len(header), raw.size))
+
+    def commit(self):
+        """Finish the results of the document, and add them to the index."""
+        # keep the shard a complete tar
+        self.end = self.file.tell()
+        self.file.write(bytes(tarfile.BLOCKSIZE * 2))
+        self.file.truncate()
+        self.file.flush()
+
+        f = io.StringIO()
+        csv.writer(f, delimiter='\t', lineterminator='\n').writerows(
+            [self.document, kind, self.shard, offset, size]
+            for kind, offset, size in self.members)
+
+        # a single write, so that the lines of the workers are not mixed
+        fd = os.open(str(self.index), os.O_WRONLY | os.O_APPEND)
+        try:
+            os.write(fd, f.getvalue().encode('utf-8'))
+        finally:
+            os.close(fd)
+
+        self.document = None
+        self.members = []
+        self.n_docs += 1
+        if self.n_docs >= self.shard_size:
+            self.file.close()
+            self.file = None
+
+    def __open_shard(self):
+        """Create a new shard of the process."""
+        while True:
+            self.seq += 1
+            self.shard = 'shard-{}-{:04d}.tar'.format(self.pid, self.seq)
+            try:
+                self.file = open(str(self.out_dir / self.shard), 'xb')
+                break
+            except FileExistsError:
+                continue
+
+        self.n_docs = 0
+        self.end = 0
+
+    @staticmethod
+    def __header(info):
+        """The header blocks of the member.
+
+        In the GNU format, the length does not depend on the size.
+        """
+        return info.tobuf(tarfile.GNU_FORMAT, 'utf-8', 'surrogateescape')
+
+
+class ArchiveReader:
+    """Read the results of the documents in the shards.
+
+    Attributes:
+        out_dir (Path): The output directory
+        entries (dict): The dictionary from the document to the dictionary
+            from the kind to (shard, offset, size) of the result
+    """
+
+    def __init__(self, out_dir):
+        """Load the index.
+
+        Args:
+            out_dir (Path): The output directory
+        """
+        self.out_dir = Path(str(out_dir))
+        self.entries = {}
+
+        with open(str(self.out_dir / INDEX_FILE), newline='') as f:
+            reader = csv.reader(f, delimiter='\t')
+            next(reader)
+            for document, kind, shard, offset, size in reader:
+                self.entries.setdefault(document, {})[kind] = (
+                    shard, int(offset), int(size))
+
+    def documents(self):
+        """Get the list of the documents."""
+        return list(self.entries)
+
+    def read(self, document, kind):
+        """Read a result of the document.
+
+        Args:
+            document (str): The document, e.g., 'paper' for paper.xhtml
+            kind (str): The kind of the result, e.g., 'word.tsv'
+
+        Returns:
+            The data (bytes), compressed if the results are compressed.
+        """
+        shard, offset, size = self.entries[document][kind]
+        with open(str(self.out_dir / shard), 'rb') as f:
+            f.seek(offset)
+            return f.read(size)
+
+
+# the writers shared in the process, keyed by the output directory
+archives = {}
+
+
+def get_archive(out_dir, shard_size=1000):
+    """Get the process-wide writer for the output directory.
+
+    The writer is created on the first call. Call this before forking
+    worker processes so that the index is created once.
+    """
+    key = str(out_dir)
+    if key not in archives:
+        archives[key] = ArchiveWriter(out_dir, shard_size)
+
+    return archives[key]
@@ -0,0 +1,317 @@
+"""
+The result cache.
+
+The results of a document are stored in the cache directory, keyed by
+the hash of the input file, the package VERSION, the hash of the math model
+and the options which change the outputs. A document whose key is in the
+cache is not processed again; its results are restored from the cache.
+
+The layout of the cache directory is:
+
+    DIR/<key[:2]>/<key>/{word.tsv,xhtml,txt,sent.tsv,math.tsv,cite.tsv}
+
+The modification time of an entry is updated whenever it is used, and the
+least recently used entries are evicted first.
+
+The feature cache keeps the training data (the features and the labels of
+the words) extracted by the MathTagger from each file, keyed by the hash of
+the file and the version of the feature extractor:
+
+    DIR/<key[:2]>/<key>
+"""
+
+# libraries
+import os
+import re
+import time
+import pickle
+import shutil
+import hashlib
+import filecmp
+from array import array
+from pathlib import Path
+from tempfile import mkdtemp, mkstemp
+
+from . import structures
+from .config import VERSION
+from .pipeline import output_files
+
+# use logger
+from logging import getLogger
+logger = getLogger('postprocess')
+
+# the keys of the results
+KEY_PATTERN = re.compile('[0-9a-f]{64}')
+
+
+# the module
+def file_hash(fn, chunk_size=1 << 20):
+    """Calculate the SHA-256 hash of the file."""
+    h = hashlib.sha256()
+    with open(str(fn), 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+class ResultCache:
+    """The on-disk cache of the results.
+
+    The cache never fails a document: if the cache directory is not usable,
+    the cache is disabled with a warning, and the results which fail to be
+    stored are just not cached.
+    """
+
+    def __init__(self, cache_dir, model_file, rebuild=False):
+        """Initialize the cache, and check the cache directory.
+
+        Args:
+            cache_dir (str): The cache directory
+            model_file (str): The model file of the MathTagger
+            rebuild (bool): Do not use the cached results, but update them
+        """
+        self.cache_dir = Path(cache_dir)
+        self.model_hash = file_hash(model_file)
+        self.rebuild = rebuild
+
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            self.usable = os.access(str(self.cache_dir), os.W_OK | os.X_OK)
+        except OSError:
+            self.usable = False
+        if not self.usable:
+            logger.warning('The cache is disabled, as the cache directory '
+                           'is not usable: {}'.format(self.cache_dir))
+
+    def key(self, fn, remove_pos=True, stream=False, compress=None):
+        """Calculate the key of the results of the file.
+
+        The input path is a part of the key, as it is written in word.tsv.
+        The results of the streaming loader are cached separately, as the
+        math tags may differ, and so are those of the parsers other than the
+        'tuned' one, which may differ in the whitespaces.
+        """
+        parts = [VERSION, self.model_hash, file_hash(fn), str(fn),
+                 str(remove_pos)]
+        if stream:
+            parts.append('stream')
+        if structures.parser_name != 'tuned':
+            parts.append('parser=' + structures.parser_name)
+        if compress:
+            parts.append('compress=' + compress)
+
+        h = hashlib.sha256()
+        for part in parts:
+            h.update(part.encode('utf-8'))
+            h.update(b'\0')
+
+        return h.hexdigest()
+
+    @staticmethod
+    def is_key(name):
+        """Check whether the name is a key, i.e., a SHA-256 hex digest."""
+        return KEY_PATTERN.fullmatch(name) is not None
+
+    def entry(self, key):
+        """Get the directory of the entry."""
+        return self.cache_dir / key[:2] / key
+
+    def restore(self, key, fn, out_dir, compress=None):
+        """Restore the cached results of the file into out_dir.
+
+        The result files in out_dir which are the same as the cached ones
+        are not copied. The modification times of all result files are set
+        to the current time, so that the incremental mode (-i) sees them as
+        up to date.
+
+        Returns:
+            True if the results are restored, otherwise False.
+        """
+        entry = self.entry(key)
+        if not self.usable or self.rebuild or not entry.is_dir():
+            return False
+
+        files = output_files(Path(str(fn)), out_dir, compress)
+        cached = {kind: entry / kind for kind in files}
+        if not all(c.is_file() for c in cached.values()):
+            return False
+
+        out_dir.mkdir(parents=True, exist_ok=True)
+        for kind, path in files.items():
+            if path.is_file() and filecmp.cmp(str(cached[kind]), str(path)):
+                os.utime(str(path))
+                continue
+            logger.debug('Restoring {} from the cache'.format(path))
+            shutil.copy(str(cached[kind]), str(path))
+
+        # mark as recently used
+        os.utime(str(entry))
+        return True
+
+    def store(self, key, fn, out_dir, compress=None):
+        """Store the results of the file in out_dir into the cache."""
+        if not self.usable:
+            return
+
+        entry = self.entry(key)
+        tmp = None
+        try:
+            entry.parent.mkdir(parents=True, exist_ok=True)
+
+            # copy into a temporary directory, then rename it atomically, as
+            # the other workers may store the same entry
+            tmp = Path(mkdtemp(prefix='.tmp-', dir=str(entry.parent)))
+            for kind, path in output_files(Path(str(fn)), out_dir,
+                                           compress).items():
+                shutil.copy2(str(path), str(tmp / kind))
+
+            if entry.is_dir():
+                shutil.rmtree(str(entry), ignore_errors=True)
+            os.rename(str(tmp), str(entry))
+
+        except OSError:
+            logger.warning('Failed to cache the results of "{}"'.format(fn))
+            if tmp is not None:
+                shutil.rmtree(str(tmp), ignore_errors=True)
+
+    def evict(self, max_size=None, max_age=None):
+        """Evict the entries.
+
+        Only the entries of the results (<key[:2]>/<key>) are evicted; the
+        other directories in the cache directory, e.g., the feature cache in
+        'features', are left as they are.
+
+        Args:
+            max_size (int): Remove the least recently used entries until the
+                total size of the cache is at most max_size bytes.
+            max_age (float): Remove the entries unused for max_age seconds.
+
+        Returns:
+            The number of the removed entries.
+        """
+        if not self.usable or not self.cache_dir.is_dir():
+            return 0
+
+        entries = []
+        for entry in self.cache_dir.glob('*/*'):
+            if not entry.is_dir() or not self.is_key(entry.name) or \
+                    entry.parent.name != entry.name[:2]:
+                continue
+            size = sum(f.stat().st_size for f in entry.iterdir())
+            entries.append((entry.stat().st_mtime, size, entry))
+
+        # the least recently used first
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+
+        removed = 0
+        for mtime, size, entry in entries:
+            too_old = max_age is not None and now - mtime > max_age
+            too_large = max_size is not None and total > max_size
+            if not too_old and not too_large:
+                continue
+
+            shutil.rmtree(str(entry), ignore_errors=True)
+            total -= size
+            removed += 1
+
+        logger.debug('Evicted {} cache entries'.format(removed))
+        return removed
+
+
+class FeatureCache:
+    """The on-disk cache of the training data of the MathTagger.
+
+    The training data is a list of (xseq, yseq) for each paragraph. It is
+    stored compactly: the attributes and the labels are replaced by the
+    indices in the tables of the distinct strings, which are kept in arrays.
+    The cache is best-effort: the data which fails to be loaded or stored
+    is just extracted again.
+    """
+
+    def __init__(self, cache_dir, version):
+        """Initialize the cache.
+
+        Args:
+            cache_dir (str): The cache directory
+            version (str): The version of the feature extractor
+        """
+        self.cache_dir = Path(cache_dir)
+        self.version = version
+
+    def key(self, fn):
+        """Calculate the key of the training data of the file."""
+        h = hashlib.sha256()
+        for part in (self.version, file_hash(fn)):
+            h.update(part.encode('utf-8'))
+            h.update(b'\0')
+
+        return h.hexdigest()
+
+    def entry(self, key):
+        """Get the file of the entry."""
+        return self.cache_dir / key[:2] / key
+
+    def load(self, key):
+        """Load the training data.
+
+        Returns:
+            The training data, or None if not cached.
+        """
+        try:
+            with open(str(self.entry(key)), 'rb') as f:
+                version, attrs, labels, lengths, counts, xs, ys = pickle.load(f)
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return None
+
+        if version != self.version:
+            return None
+
+        data = []
+        w = 0
+        x = 0
+        for length in lengths:
+            xseq = []
+            for count in counts[w:w + length]:
+                xseq.append([attrs[i] for i in xs[x:x + count]])
+                x += count
+            yseq = [labels[i] for i in ys[w:w + length]]
+            data.append((xseq, yseq))
+            w += length
+
+        return data
+
+    def store(self, key, data):
+        """Store the training data."""
+        attrs = {}
+        labels = {}
+        lengths = array('I')
+        counts = array('I')
+        xs = array('I')
+        ys = array('I')
+        for xseq, yseq in data:
+            lengths.append(len(xseq))
+            for features in xseq:
+                counts.append(len(features))
+                xs.extend(attrs.setdefault(a, len(attrs)) for a in features)
+            ys.extend(labels.setdefault(y, len(labels)) for y in yseq)
+
+        entry = self.entry(key)
+        tmp = None
+        try:
+            entry.parent.mkdir(parents=True, exist_ok=True)
+
+            # write into a temporary file, then rename it atomically, as the
+            # other workers may store the same entry
+            fd, tmp = mkstemp(prefix='.tmp-', dir=str(entry.parent))
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((self.version, list(attrs), list(labels), lengths,
+                             counts, xs, ys), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, str(entry))
+
+        except OSError:
+            logger.warning('Failed to cache the features')
+            if tmp is not None and os.path.exists(tmp):
+                os.unlink(tmp)
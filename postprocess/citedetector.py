@@ -8,13 +8,14 @@ The CiteDetector module.
 import sys
 import copy
 import regex
+from functools import lru_cache
 from pathlib import Path
 from docopt import docopt
-from lxml import etree
 
 from .config import PKG_NAME, VERSION
 from .cli_utils import set_logger
-from .structures import Document, Paragraph, Word, Sentence
+from .structures import Document, Paragraph, Word, Sentence, set_parser
+from .compression import base_name
 
 # help text
 MOD_NAME = "{}.citedetector".format(PKG_NAME)
@@ -31,6 +32,8 @@ Options:
     -h, --help             Show this screen and exit.
     -l FILE, --log=FILE    Output messages to FILE.
     -o DIR, --out=DIR      Output files to DIR.
+    --parser=NAME          Parse the XHTML with the parser NAME: 'tuned',
+                           'compact' or 'default' [default: tuned].
     -q, --quiet            Show less messages.
     -v, --verbose          Show more messages.
     -V, --version          Show version.
@@ -43,10 +46,54 @@ logger = getLogger('postprocess')
 
 
 # the module
+class CaseFolding(dict):
+    """A translation table for str.translate which folds the cases.
+
+    The characters which match each other with regex.IGNORECASE are mapped to
+    the same string, so that a case-insensitive match of a pattern implies a
+    substring match of the folded texts.
+    """
+
+    def __missing__(self, key):
+        folded = chr(key).lower().upper().lower()
+        if folded == 'i\u0307':  # U+0130 (İ) matches 'i'
+            folded = 'i'
+        self[key] = folded
+        return folded
+
+
 class CiteDetector:
     ns = {'x': 'http://www.w3.org/1999/xhtml'}
     year = '(?:19\d\d|20\d\d|[6789]\d)[a-g]?|forthcoming'
     plural = regex.compile('^(?:and|et|al|others)$')
+    folding = CaseFolding()
+
+    # citation patterns
+    person = '(?:van |de |\p{Lu}\p{Latin}+|Ciaramita)'
+    head_phrase = '(?:eg\.|e\.g\.,?|see, e\.g\.,|cf\.|see|See) '
+    foot_phrase = '(?:inter alia| |,|\.)+'
+
+    type1 = regex.compile("(?:\((?:{head_phrase})?({person}[^()]*{year})(?:{foot_phrase})?\))|(?:\[(?:{head_phrase})?({person}[^\[\]]*{year})(?:{foot_phrase})?\])".format(head_phrase=head_phrase, person=person, year=year, foot_phrase=foot_phrase))
+    type2 = regex.compile("({person}(?:\sand\s{person}|[, ]+et[\. ]al)?)[\., ]*(?:['’]s )?[\(\[]((?:{year}|[;, ])+)[\)\]]".format(person=person, year=year))
+    type3 = regex.compile("\[({person})[, ]+(\d\d?)\]".format(person=person))
+    type4 = regex.compile("\[([^\[]+?)\]")
+
+    # patterns used while matching citations and references
+    year_delimiter = regex.compile('{year}(\W)\D'.format(year=year))
+    year_pair = regex.compile('{year}[,; ]+{year}'.format(year=year))
+    year_list = regex.compile('^(\D+?)({year}(?:[,; ]+{year})+)$'.format(year=year))
+    year_group = regex.compile(r'({0})'.format(year))
+    digit_head = regex.compile('^\d')
+    year_separator = regex.compile('[;, ]+')
+    element_separator = regex.compile(r'[,\. ]+')
+    et_al = regex.compile('et[,\. ]+al|others')
+    whitespace = regex.compile("\s")
+    refer = regex.compile('<refer cite="(.+?)" type="(.*?)" cue="(.*?)">')
+    phrase_delimiter = regex.compile('([ ,.\(\)\[\];:])')
+    tabs = regex.compile('\t+')
+    close_bracket = regex.compile('[\)\]]')
+    bracket1 = regex.compile('^\[([^\[]+?)\]')
+    bracket2 = regex.compile('^(\d\d?)\.\s?\p{Lu}')
 
     def __init__(self):
         """Initialize CiteDetector.
@@ -58,18 +105,27 @@ class CiteDetector:
         """
         self.tokenizer = ''
 
-    def open(self, doc):
+    def open(self, doc, references=None):
         """Open a XHTML file.
 
         Args:
             doc (Document): The input document.
+            references (list): The references of the whole document found
+                by split_references, when the document is processed section
+                by section. If None, the references in the document are used.
         """
         self.matched = {}
         self.match_id = 0
         self.match_context = {}
         self.doc = doc
         self.docid = self.__get_docid()
-        self.__split_references()
+        if references is None:
+            self.references, self.body = self.split_references(doc)
+            doc.stats.count('cite.references', len(self.references))
+        else:
+            self.body = self.split_references(doc)[1]
+            self.references = references
+        self.__index_references()
         self.__extract_reference_key()
         logger.info('Now docid = {}'.format(self.docid))
 
@@ -79,26 +135,22 @@ class CiteDetector:
         Args:
             doc (Document): The input document.
         """
-        person = '(?:van |de |\p{Lu}\p{Latin}+|Ciaramita)'
-        head_phrase = '(?:eg\.|e\.g\.,?|see, e\.g\.,|cf\.|see|See) '
-        foot_phrase = '(?:inter alia| |,|\.)+'
-
-        type1 = regex.compile("(?:\((?:{head_phrase})?({person}[^()]*{year})(?:{foot_phrase})?\))|(?:\[(?:{head_phrase})?({person}[^\[\]]*{year})(?:{foot_phrase})?\])".format(head_phrase=head_phrase, person=person, year=CiteDetector.year, foot_phrase=foot_phrase))
-
-        type2 = regex.compile("({person}(?:\sand\s{person}|[, ]+et[\. ]al)?)[\., ]*(?:['’]s )?[\(\[]((?:{year}|[;, ])+)[\)\]]".format(person=person, year=CiteDetector.year))
-        type3 = regex.compile("\[({person})[, ]+(\d\d?)\]".format(person=person))
-        type4 = regex.compile("\[([^\[]+?)\]")
+        stats = self.doc.stats
+        with stats.stage('cite.match'):
+            for ref in self.body:
+                hoge = copy.copy(ref['text'])
+                # type1.sub(lambda m: self.__replace1(m), ref['text'])
+                ref['text'] = CiteDetector.type1.sub(self.__replace1, ref['text'])
+                ref['text'] = CiteDetector.type2.sub(self.__replace2, ref['text'])
+                ref['text'] = CiteDetector.type3.sub(self.__replace3, ref['text'])
+                if bool(self.ref_key):
+                    ref['text'] = CiteDetector.type4.sub(self.__replace4, ref['text'])
 
-        for ref in self.body:
-            hoge = copy.copy(ref['text'])
-            # type1.sub(lambda m: self.__replace1(m), ref['text'])
-            ref['text'] = type1.sub(self.__replace1, ref['text'])
-            ref['text'] = type2.sub(self.__replace2, ref['text'])
-            ref['text'] = type3.sub(self.__replace3, ref['text'])
-            if bool(self.ref_key):
-                ref['text'] = type4.sub(self.__replace4, ref['text'])
+        with stats.stage('cite.mark'):
+            self.__cite_mark_range()
 
-        self.__cite_mark_range()
+        stats.count('cite.paragraphs', len(self.body))
+        stats.count('cite.citations', self.match_id)
 
 
     def output_xhtml(self, filename=None):
@@ -108,38 +160,91 @@ class CiteDetector:
         """
         if filename is None:
             logger.info("Output xhtml to stdout")
-            sys.stdout.buffer.write(etree.tostring(self.doc.tree))
+            self.doc.write(sys.stdout.buffer)
         else:
             logger.info("Output xhtml to '{}'".format(filename))
             with open(filename, 'w+b') as fp:
-                fp.write(etree.tostring(self.doc.tree))
+                self.doc.write(fp)
+
 
+    @staticmethod
+    def split_references(doc):
+        """Split the paragraphs into the references and the others.
 
-    def __split_references(self):
-        self.references = []
-        self.body = []
-        for sec in self.doc.tree.xpath('x:body/x:div', namespaces=CiteDetector.ns):
-            sec_id = sec.get('id')
-            sec_name = sec.get('data-name')
+        Returns:
+            A tuple (references, body) of the lists of the paragraphs, as
+            dictionaries with 'id', 'text', 'node' and 'paragraph'.
+        """
+        references = []
+        body = []
+        for sec in doc.layout.sections:
+            sec_id = sec._id
+            sec_name = sec.name
 
-            for box in sec.xpath('x:div', namespaces=CiteDetector.ns):
-                box_name = box.get('data-name')
+            for box in sec.boxes:
+                box_name = box.name
 
-                for par in box.xpath('x:p', namespaces=CiteDetector.ns):
+                for par in box.paragraphs:
                     ref = {
-                        'id': par.get('id'),
-                        'text': par.get('data-text'),
-                        'node': par
+                        'id': par._id,
+                        'text': par.node.get('data-text'),
+                        'node': par.node,
+                        'paragraph': par
                     }
                     if box_name == 'Reference':
-                        self.references.append(ref)
+                        references.append(ref)
                     else:
-                        self.body.append(ref)
+                        body.append(ref)
+
+        return references, body
+
+
+    def __index_references(self):
+        """Prepare the index of the references for __search_reference.
+
+        The index maps a case-folded element of citation strings to the
+        positions of the references which contain it. It is filled on demand,
+        as the same names and years are cited repeatedly in a paper. The
+        results of the searches are also cached by the citation string.
+        """
+        self.folded_references = [
+            ref['text'].translate(CiteDetector.folding)
+            for ref in self.references
+        ]
+        self.reference_index = {}
+        self.search_reference = lru_cache(maxsize=1024)(
+            self.__search_reference)
+
+    def __find_candidates(self, elem):
+        """Find the positions of references which may match all elements.
+
+        A reference can match the pattern of __search_reference only if it
+        contains all of the elements case-insensitively.
+        """
+        candidates = None
+        for e in elem:
+            key = e.translate(CiteDetector.folding)
+            if key not in self.reference_index:
+                self.reference_index[key] = {
+                    i
+                    for i, text in enumerate(self.folded_references)
+                    if key in text
+                }
+            if candidates is None:
+                candidates = self.reference_index[key]
+            else:
+                candidates = candidates & self.reference_index[key]
+            if not candidates:
+                break
+
+        if candidates is None:
+            return range(len(self.references))
 
+        return sorted(candidates)
 
     def __extract_reference_key(self):
-        bracket1 = regex.compile('^\[([^\[]+?)\]')
-        bracket2 = regex.compile('^(\d\d?)\.\s?\p{Lu}')
+        bracket1 = CiteDetector.bracket1
+        bracket2 = CiteDetector.bracket2
         self.ref_key = {}
         for ref in self.references:
             m1 = bracket1.match(ref['text'])
@@ -169,19 +274,19 @@ class CiteDetector:
     def __replace1(self, mat):
         whole = mat.group(1) or mat.group(2)
         tmp_whole = regex.sub('', '\s', whole)
-        m = regex.search('{year}(\W)\D'.format(year=CiteDetector.year), tmp_whole)
+        m = CiteDetector.year_delimiter.search(tmp_whole)
         splitStr = m.group(1) if m else ';'
-        cites = regex.split('(?<=\d\d|\d[abcde])\s?{0}\s*'.format(splitStr), whole)
-        m = regex.match('{year}[,; ]+{year}'.format(year=CiteDetector.year), tmp_whole)
+        cites = self.__cite_separator(splitStr).split(whole)
+        m = CiteDetector.year_pair.match(tmp_whole)
         if m:
             cites = self.__split_year(cites)
 
         cids = []
         for cite in cites:
-            m = regex.match('^\d', cite)
+            m = CiteDetector.digit_head.match(cite)
             if m:
                 continue
-            match = self.__search_reference(cite)
+            match = self.search_reference(cite)
             if len(match) == 0:
                 continue
             cid = match[0]['cid']
@@ -205,11 +310,11 @@ class CiteDetector:
 
     def __replace2(self, mat):
         whole, names = mat.group(), mat.group(1)
-        years = regex.split('[;, ]+', mat.group(2))
+        years = CiteDetector.year_separator.split(mat.group(2))
 
         cids = []
         for year in years:
-            match = self.__search_reference(names + ' ' + year)
+            match = self.search_reference(names + ' ' + year)
             if len(match) == 0:
                 continue
             cid = match[0]['cid']
@@ -232,7 +337,7 @@ class CiteDetector:
 
     def __replace3(self, mat):
         whole, name, year = mat.group(), mat.group(1), mat.group(2)
-        match = self.__search_reference(name + ' ' + year)
+        match = self.search_reference(name + ' ' + year)
         if len(match):
             cid = match[0]['cid']
             if cid not in self.matched:
@@ -251,10 +356,10 @@ class CiteDetector:
 
     def __replace4(self, mat):
         whole, hit = mat.group(), mat.group(1)
-        tmp_hit = regex.sub("\s", "", hit)
+        tmp_hit = CiteDetector.whitespace.sub("", hit)
         cids = []
-        for key in regex.split(",", tmp_hit):
-            key = regex.sub("\s", "", key)
+        for key in tmp_hit.split(","):
+            key = CiteDetector.whitespace.sub("", key)
             if key in self.ref_key:
                 cid = self.ref_key[key]
             else:
@@ -279,11 +384,12 @@ class CiteDetector:
 
     def __cite_mark_range(self):
         identify_type = IdentifyType()
-        refer = regex.compile('<refer cite="(.+?)" type="(.*?)" cue="(.*?)">')
+        refer = CiteDetector.refer
         self.cid2phrase = {}
         for ref in self.body:
             paragraph = identify_type.identify_citation_type(ref['text'])
-            self.spans = ref['node'].xpath('x:span', namespaces=CiteDetector.ns)
+            self.paragraph = ref['paragraph']
+            self.spans = self.paragraph.spans
             self.match_span = [False] * len(self.spans)
             if paragraph is not None:
                 refer.sub(self.__annotate_tag, paragraph)
@@ -293,10 +399,10 @@ class CiteDetector:
         logger.info("match_id: {}, rType: {}, cue: {}".format(match_id, rtype, cue))
         mc = self.match_context[int(match_id)]
         # hit = 'no hit'
-        context = regex.sub('([ ,.\(\)\[\];:])', '\t\\1\t', mc['context'])
-        phrase = [ p for p in regex.split('\t+', context) if p != ' ' ]
+        context = CiteDetector.phrase_delimiter.sub('\t\\1\t', mc['context'])
+        phrase = [ p for p in CiteDetector.tabs.split(context) if p != ' ' ]
         last_year_idx = len(phrase) - 1
-        if regex.search('[\)\]]', phrase[-1]):
+        if CiteDetector.close_bracket.search(phrase[-1]):
             len(phrase) - 2 
 
         ## delete brackets
@@ -305,7 +411,7 @@ class CiteDetector:
             last_year_idx = len(phrase) - 1
 
         spans = self.spans
-        for i in range(0, len(spans)):
+        for i in self.paragraph.find_spans(phrase[0]):
             if i+last_year_idx < len(spans) and \
                spans[i].text is not None and \
                spans[i+last_year_idx].text is not None and \
@@ -326,12 +432,13 @@ class CiteDetector:
 
 
     def __search_reference(self, string):
-        string = regex.sub(r'({0})'.format(CiteDetector.year), ' \\1', string)
-        elem = regex.split(r'[,\. ]+', string)
-        elem = [ regex.escape(e) for e in elem if not CiteDetector.plural.search(e) ] 
-        reg = regex.compile('\W.*?'.join(elem), regex.IGNORECASE)
+        string = CiteDetector.year_group.sub(' \\1', string)
+        elem = CiteDetector.element_separator.split(string)
+        elem = [ e for e in elem if not CiteDetector.plural.search(e) ]
+        reg = regex.compile('\W.*?'.join(map(regex.escape, elem)), regex.IGNORECASE)
         match = []
-        for ref in self.references:
+        for i in self.__find_candidates(elem):
+            ref = self.references[i]
             m = reg.search(ref['text'])
             if m:
                 match.append({
@@ -340,17 +447,23 @@ class CiteDetector:
                     'total': len(m.group())
                 })
         if len(match) > 1:
-            if regex.search('et[,\. ]+al|others', string):
+            if CiteDetector.et_al.search(string):
                 match = sorted(match, key=lambda x:(x['start'],-x['total']))
             else:
                 match = sorted(match, key=lambda x:(x['start'],x['total']))
         return match
 
 
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def __cite_separator(split_str):
+        """Get the pattern which splits citations by the separator."""
+        return regex.compile('(?<=\d\d|\d[abcde])\s?{0}\s*'.format(split_str))
+
     def __split_year(cites):
         out = []
         for cite in cites:
-            m = regex.match('^(\D+?)({year}(?:[,; ]+{year})+)$'.format(year=CiteDetector.year), cite)
+            m = CiteDetector.year_list.match(cite)
             if m:
                 names, years = m.group(1), m.group(2)
                 for s in regex.split('[, ]+', years):
@@ -360,6 +473,18 @@ class CiteDetector:
         return out
 
 
+def compile_cues(cues):
+    """Compile the cue patterns.
+
+    Returns:
+        A tuple of a pattern which matches any of the cues, and the list of
+        the compiled cues. The former tells in one pass whether the latter
+        should be tried one by one.
+    """
+    any_cue = regex.compile('|'.join('(?:{})'.format(cue) for cue in cues))
+    return any_cue, [regex.compile(cue) for cue in cues]
+
+
 class IdentifyType:
     typeB = [
         '[Ww]e adopt',
@@ -430,37 +555,47 @@ class IdentifyType:
         ]}
     ]
 
+    # compiled cues; see compile_cues
+    typeB_cues = compile_cues(typeB)
+    typeC_cues = [(cue['context'], compile_cues(cue['regex'])) for cue in typeC]
+
+    sentence_boundary = regex.compile("(?<=\.) (?=\p{Lu})")
+    refer = regex.compile('<refer cite="(.+?)">')
+
     def identify_citation_type(self, paragraph):
-        sentences = regex.split("(?<=\.) (?=\p{Lu})", paragraph)
+        sentences = IdentifyType.sentence_boundary.split(paragraph)
         for i in range(0, len(sentences)):
-            m = regex.search('<refer', sentences[i])
-            if not m:
+            if '<refer' not in sentences[i]:
                 continue
             citeType, cue = self.__rule_type_new_cue(sentences, i)
-            sentences[i] = regex.sub('<refer cite="(.+?)">', '<refer cite="\\1" type="{0}" cue="{1}">'.format(citeType, cue), sentences[i])
+            sentences[i] = IdentifyType.refer.sub('<refer cite="\\1" type="{0}" cue="{1}">'.format(citeType, cue), sentences[i])
                 
         return " ".join(sentences)
 
 
     def __rule_type_new_cue(self, sentences, i):
-        for cue in IdentifyType.typeC:
+        for offsets, (any_cue, cues) in IdentifyType.typeC_cues:
             context = []
-            for j in cue['context']:
+            for j in offsets:
                 if i+j < len(sentences):
                     context.append(sentences[i+j])
             cont = ' '.join(context)
-            for reg in cue['regex']:
-                m = regex.search(reg, cont)
+            if not any_cue.search(cont):
+                continue
+            for reg in cues:
+                m = reg.search(cont)
                 if m:
                     return 'C', m.group().strip(',. ]')
 
         cont = sentences[i]
         if i+1 < len(sentences):
             cont = cont + ' ' + sentences[i+1]
-        for cue in IdentifyType.typeB:
-            m = regex.search(cue, cont)
-            if m:
-                return 'B', m.group().strip(',. ]')
+        any_cue, cues = IdentifyType.typeB_cues
+        if any_cue.search(cont):
+            for cue in cues:
+                m = cue.search(cont)
+                if m:
+                    return 'B', m.group().strip(',. ]')
 
         return 'O', ''
 
@@ -482,6 +617,13 @@ def citedetector_cui():
 
     set_logger(log_level, log_file)
 
+    # the parser
+    try:
+        set_parser(args['--parser'])
+    except ValueError as e:
+        logger.error(e)
+        sys.exit(1)
+
     citedetector = CiteDetector()
     fn = Path(args['XHTML'])
     doc = Document(str(fn))
@@ -491,7 +633,7 @@ def citedetector_cui():
     if args['--out']:
         out_dir = Path(args['--out'])
         out_dir.mkdir(parents=True, exist_ok=True)
-        citedetector.output_xhtml(str(out_dir / fn.name))
+        citedetector.output_xhtml(str(out_dir / base_name(fn).name))
     else:
         citedetector.output_xhtml()
 
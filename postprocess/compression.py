@@ -0,0 +1,105 @@
+"""
+The compressed inputs and outputs.
+
+The inputs compressed with gzip, xz or zstd are detected by their magic
+numbers, and decompressed as a stream into the parser. The result files can
+be compressed with one of the METHODS, whose name is appended to the names
+of the files as the suffix (e.g., paper.word.tsv.gz).
+
+zstd needs the zstandard package (pip install zstandard).
+"""
+
+# libraries
+import gzip
+import lzma
+from pathlib import Path, PurePath
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# the compression methods, keyed by the suffix, with the magic numbers
+METHODS = {
+    'gz': b'\x1f\x8b',
+    'xz': b'\xfd7zXZ\x00',
+    'zst': b'\x28\xb5\x2f\xfd',
+}
+
+# the compression levels; fast ones, as the outputs are written once per file
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+# the module
+def check(method):
+    """Check whether the compression method is available.
+
+    Raises:
+        ValueError: If the method is unknown or not available.
+    """
+    if method not in METHODS:
+        raise ValueError('Unknown compression method: {}'.format(method))
+
+    if method == 'zst' and zstandard is None:
+        raise ValueError('zstd needs the zstandard package')
+
+
+def detect(fn):
+    """Detect the compression method of the file by its magic number.
+
+    Returns:
+        The name of the method, or None if not compressed.
+    """
+    with open(str(fn), 'rb') as f:
+        head = f.read(max(len(magic) for magic in METHODS.values()))
+
+    for method, magic in METHODS.items():
+        if head.startswith(magic):
+            return method
+
+    return None
+
+
+def open_file(fn, mode='rb', method=None, **kwargs):
+    """Open the file compressed with the method, as the built-in open does.
+
+    Args:
+        fn (str): The file, or a binary file object if compressed
+        mode (str): The mode, e.g., 'rb', 'wb' or 'wt'
+        method (str): The compression method, or None for a plain file
+        kwargs: Passed to the opener, e.g., encoding and newline
+
+    Returns:
+        The file object.
+    """
+    if isinstance(fn, PurePath):
+        fn = str(fn)
+    if method is None:
+        return open(fn, mode, **kwargs)
+
+    check(method)
+    if method == 'gz':
+        return gzip.open(fn, mode, compresslevel=GZIP_LEVEL, **kwargs)
+    elif method == 'xz':
+        return lzma.open(fn, mode, **kwargs)
+    elif 'r' in mode:
+        return zstandard.open(fn, mode, **kwargs)
+    else:
+        cctx = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+        return zstandard.open(fn, mode, cctx=cctx, **kwargs)
+
+
+def base_name(fn):
+    """Get the name of the file without the suffix of the compression.
+
+    For example, 'paper.xhtml' for 'paper.xhtml.gz'.
+
+    Returns:
+        The Path.
+    """
+    fn = Path(str(fn))
+    if fn.suffix[1:] in METHODS:
+        return fn.with_suffix('')
+
+    return fn
@@ -2,5 +2,16 @@
 Configuration
 """
 
+import os
+from pathlib import Path
+
 PKG_NAME = "postprocess"
 VERSION = "{} 0.3.0".format(PKG_NAME)
+
+# the default model file of the MathTagger
+MODEL_FILE = str(
+    Path(__file__).parent / 'mathtagger' / 'model' / 'inline_math.model')
+
+# the default directory of the result cache
+CACHE_DIR = str(
+    Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / PKG_NAME)
@@ -0,0 +1,189 @@
+"""
+The SQLite output.
+
+Instead of the TSV files (word.tsv, sent.tsv, math.tsv and cite.tsv), the
+results can be written into a SQLite database, with a table for each kind
+of the results, keyed by the docid in head/meta of the document (or the
+name of the input file if not defined):
+
+    documents (docid, source)
+    words (docid, word_id, from_pos, to_pos, sent_id)
+    sentences (docid, sent_id, sect_name, box_name, text, words)
+    maths (docid, math_id, start_id, end_id, page, x1, y1, x2, y2)
+    cites (docid, cite_id, text, words)
+
+The words and the sentences are indexed by the docid and the sentence id,
+and the others by the docid. The results of a document are inserted in one
+transaction, replacing those of a document with the same docid.
+
+The database is in the WAL mode, so that the worker processes can write
+their documents concurrently; each process has its own connection, and the
+writers wait for each other up to TIMEOUT seconds.
+"""
+
+# libraries
+import os
+import sqlite3
+from pathlib import Path
+
+# use logger
+from logging import getLogger
+logger = getLogger('postprocess')
+
+# the seconds to wait for the other writers
+TIMEOUT = 600
+
+# the tables and the indexes
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    docid TEXT PRIMARY KEY,
+    source TEXT
+);
+CREATE TABLE IF NOT EXISTS words (
+    docid TEXT NOT NULL,
+    word_id TEXT,
+    from_pos INTEGER,
+    to_pos INTEGER,
+    sent_id TEXT
+);
+CREATE TABLE IF NOT EXISTS sentences (
+    docid TEXT NOT NULL,
+    sent_id TEXT,
+    sect_name TEXT,
+    box_name TEXT,
+    text TEXT,
+    words TEXT
+);
+CREATE TABLE IF NOT EXISTS maths (
+    docid TEXT NOT NULL,
+    math_id TEXT,
+    start_id TEXT,
+    end_id TEXT,
+    page INTEGER,
+    x1 REAL,
+    y1 REAL,
+    x2 REAL,
+    y2 REAL
+);
+CREATE TABLE IF NOT EXISTS cites (
+    docid TEXT NOT NULL,
+    cite_id TEXT,
+    text TEXT,
+    words TEXT
+);
+CREATE INDEX IF NOT EXISTS words_sent ON words (docid, sent_id);
+CREATE INDEX IF NOT EXISTS sentences_sent ON sentences (docid, sent_id);
+CREATE INDEX IF NOT EXISTS maths_doc ON maths (docid);
+CREATE INDEX IF NOT EXISTS cites_doc ON cites (docid);
+"""
+
+# the tables of the results of a document
+TABLES = ['words', 'sentences', 'maths', 'cites']
+
+
+# the module
+class Database:
+    """Write the results of the documents into the SQLite database.
+
+    Use get_database() to get the database shared in the process; a
+    database inherited by a forked worker opens the connection of its own.
+    """
+
+    def __init__(self, fn):
+        """Create the tables if missing, and set the WAL mode.
+
+        Args:
+            fn (str): The database file
+        """
+        self.filename = str(fn)
+        self.pid = None
+        self.conn = None
+
+        # the connection is closed, so that no connection is inherited by
+        # the forked workers
+        Path(self.filename).parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.filename, timeout=TIMEOUT)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+        finally:
+            conn.close()
+
+    def connect(self):
+        """Get the connection of the process."""
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.conn = sqlite3.connect(
+                self.filename, timeout=TIMEOUT, isolation_level=None)
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+
+        return self.conn
+
+    def store(self, doc, docid, source):
+        """Write the results of the document in a transaction.
+
+        Args:
+            doc (Document): The processed document
+            docid (str): The docid of the document
+            source (str): The input file
+        """
+        conn = self.connect()
+
+        # lock the database before reading, so that no other writer comes
+        # between the check and the inserts
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT source FROM documents WHERE docid = ?',
+                               (docid, )).fetchone()
+            if row is not None and row[0] != source:
+                logger.warning('The results of docid "{}" of "{}" are '
+                               'replaced by those of "{}"'.format(
+                                   docid, row[0], source))
+            for table in ['documents'] + TABLES:
+                conn.execute('DELETE FROM {} WHERE docid = ?'.format(table),
+                             (docid, ))
+
+            conn.execute('INSERT INTO documents VALUES (?, ?)',
+                         (docid, source))
+
+            sentences = doc.sentences
+            words = doc.words
+            conn.executemany(
+                'INSERT INTO words VALUES (?, ?, ?, ?, ?)',
+                ((docid, _id, start, end,
+                  sentences[s]._id if s >= 0 else None)
+                 for _id, start, end, s in zip(words.ids, words.starts,
+                                               words.ends, words.sentences)))
+            conn.executemany(
+                'INSERT INTO sentences VALUES (?, ?, ?, ?, ?, ?)',
+                ((docid, s._id, s.sec_name, s.box_name, s.text.strip(),
+                  ','.join(s.words)) for s in sentences))
+            conn.executemany(
+                'INSERT INTO maths VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                ((docid, ) + tuple(m) for m in doc.maths))
+            conn.executemany(
+                'INSERT INTO cites VALUES (?, ?, ?, ?)',
+                ((docid, c[0], c[1], ','.join(c[2])) for c in doc.cites))
+
+            conn.execute('COMMIT')
+
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+
+# the databases shared in the process, keyed by the file
+databases = {}
+
+
+def get_database(fn):
+    """Get the process-wide database for the file.
+
+    The database is created on the first call. Call this before forking
+    worker processes so that the tables are created once.
+    """
+    fn = str(fn)
+    if fn not in databases:
+        databases[fn] = Database(fn)
+
+    return databases[fn]
@@ -20,43 +20,71 @@ class FigureTagger:
         """
         logger.info('FigureTagger initialized.')
 
-    def tag(self, doc):
+    def tag(self, doc, figures=None):
         """Embed data-figref, data-figref-id, and data-figref-end tags (attributes) to the document.
 
         Args:
             doc (Document): The input document.
+            figures (defaultdict): The figures of the whole document found by
+                find_figures, when the document is tagged section by section.
+                If None, the figures in the document are used.
         """
-        figures, paragraphs = self.__extract_figures(doc)
+        if figures is None:
+            figures = self.find_figures(doc)
+            doc.stats.count('figure.figures', len(figures))
+
+        paragraphs = self.__extract_paragraphs(doc)
         self.__search_context_and_tag(figures, paragraphs)
 
-    def __extract_figures(self, doc):
-        """Extract target figures and paragraphs.
+        doc.stats.count('figure.paragraphs', len(paragraphs))
+
+    def find_figures(self, doc, figures=None):
+        """Find the figures in the document.
 
         Args:
             doc (Document): The input document.
+            figures (defaultdict): The figures found so far, to which the
+                figures in the document are added.
 
         Returns:
             figures (defaultdict): Number of occurence of a data-fig.
-            paragraphs (array): Paragraphs that are NOT captions, figures, or tables.
         """
-        figures = defaultdict(int)
-        paragraphs = []
+        if figures is None:
+            figures = defaultdict(int)
 
-        for box in doc.tree.xpath(
-                'x:body/x:div/x:div[@data-name]', namespaces=FigureTagger.ns):
-            for p in box.xpath('x:p', namespaces=FigureTagger.ns):
-                if 'data-fig' in p.attrib:
+        for box in doc.layout.boxes:
+            if box.name is None:
+                continue
+
+            for p in box.paragraphs:
+                if 'data-fig' in p.node.attrib:
                     # Paragraph with data-fig attribute is a figure
-                    figures[p.attrib['data-fig']] += 1
-                    logger.debug('{} {}'.format(p.attrib['data-fig'],
-                                                p.attrib['id']))
+                    figures[p.node.attrib['data-fig']] += 1
+                    logger.debug('{} {}'.format(p.node.attrib['data-fig'],
+                                                p._id))
+
+        return figures
+
+    def __extract_paragraphs(self, doc):
+        """Extract target paragraphs.
+
+        Args:
+            doc (Document): The input document.
+
+        Returns:
+            paragraphs (array): Paragraphs (ParagraphNode) that are NOT captions, figures, or tables.
+        """
+        paragraphs = []
+
+        for box in doc.layout.boxes:
+            if box.name is None:
+                continue
 
-                if 'data-name' in box.attrib and \
-                        box.attrib['data-name'] not in ['Caption', 'Figure', 'Table']:
-                    # Paragraphs that are not captions, figures, or tables
-                    paragraphs.append(p)
+            if box.name not in ['Caption', 'Figure', 'Table']:
+                # Paragraphs that are not captions, figures, or tables
+                paragraphs.extend(box.paragraphs)
 
-        return figures, paragraphs
+        return paragraphs
 
     def __search_context_and_tag(self, figures, paragraphs):
         """Search contexts that refers to figures, and tag them.
@@ -65,6 +93,8 @@ class FigureTagger:
             figures (defaultdict): Number of occurence of a data-fig.
             paragraphs (array): Paragraphs that are NOT captions, figures, or tables.
         """
+        # compile the patterns of each figure once
+        refers = defaultdict(list)
         for data_fig in figures.keys():
             typ, num = data_fig.split('_', 1)
             refer = []
@@ -72,26 +102,76 @@ class FigureTagger:
             refer.append('{}s?(?:\s*\d+(?:and|,|\s)+)+{}'.format(
                 typ, num))  # ex. Figures 1, 2, and 3
             # TODO: Context with sub-indexes, i.e. "Figures 4 (a) and 4 (b) show ..."
+            patterns = [
+                re.compile('({})(?:\s|\)|\.\D|\.$|,|:)'.format(r))
+                for r in refer
+            ]
+            refers[typ].append((data_fig, patterns))
+
+        # scan each paragraph once; a reference starts where the type occurs
+        phrases = defaultdict(list)
+        for p in paragraphs:
+            text = p.node.attrib['data-text']
+            for typ, figs in refers.items():
+                starts = self.__find_starts(text, typ)
+                if not starts:
+                    continue
+
+                for data_fig, patterns in figs:
+                    phrase = self.__match_first(patterns, text, starts)
+                    if phrase:
+                        phrases[data_fig].append((p, phrase))
+
+        # tag figure by figure, in the order of the document
+        for data_fig in figures.keys():
+            for p, phrase in phrases[data_fig]:
+                self.__embed_attribute(p, phrase, data_fig)
+
+    @staticmethod
+    def __find_starts(text, typ):
+        """Find the positions where a reference to the type may start.
 
-            for p in paragraphs:
-                text = p.attrib['data-text']
-                phrase = None
-                for r in refer:
-                    res = re.search('({})(?:\s|\)|\.\D|\.$|,|:)'.format(r),
-                                    text)
-                    if res:
-                        phrase = res.group(1)
-                        break
+        Args:
+            text (str): The text of a paragraph.
+            typ (str): The type of figures, e.g. 'Figure'.
+
+        Returns:
+            The list of positions.
+        """
+        if re.escape(typ) != typ:
+            # the type is used as a pattern; try everywhere
+            return list(range(len(text) + 1))
+
+        starts = []
+        start = text.find(typ)
+        while start >= 0:
+            starts.append(start)
+            start = text.find(typ, start + 1)
+
+        return starts
+
+    @staticmethod
+    def __match_first(patterns, text, starts):
+        """Match the patterns in order, and return the leftmost phrase of
+        the first pattern which matches.
+
+        This is the same as searching the patterns in the whole text, as they
+        can only match at the starts.
+        """
+        for pattern in patterns:
+            for start in starts:
+                res = pattern.match(text, start)
+                if res:
+                    return res.group(1)
 
-                if phrase:
-                    self.__embed_attribute(p, phrase, data_fig)
+        return None
 
     def __embed_attribute(self, p, phrase, data_fig):
-        spans = p.xpath('x:span', namespaces=FigureTagger.ns)
+        spans = p.spans
         phrase = re.sub(r'([,.:])', r' \1 ', phrase)
         words = re.split(r'\s', phrase)
 
-        for i in range(len(spans)):
+        for i in p.find_spans(words[0]):
             length = len(words) - 1  # length of spans that covers the phrase
             for j in range(i + 1, i + len(words)):
                 if len(spans) > j and not spans[j].text:
@@ -0,0 +1,142 @@
+"""
+Instrumentation of the stages.
+
+Each Document has a Stats, which records the wall time and the CPU time of
+the stages and the counters (words, paragraphs, tags, ...) of the document.
+The stages are measured with the stage() context manager:
+
+    with doc.stats.stage('math.crf'):
+        yseq = tagger.tag(xseq)
+    doc.stats.count('math.tags', total)
+
+A Report collects the stats of the documents in a run, and dumps them with
+the percentiles over the documents as JSON or TSV.
+"""
+
+# libraries
+import csv
+import json
+import time
+from contextlib import contextmanager
+
+
+# the module
+class Stats:
+    """Timings and counters of a document."""
+
+    def __init__(self):
+        self.wall = {}
+        self.cpu = {}
+        self.counters = {}
+
+    @contextmanager
+    def stage(self, name):
+        """Measure the wall time and the CPU time of the stage.
+
+        The times of the same stage are summed up.
+        """
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            self.wall[name] = self.wall.get(name, 0.0) + \
+                time.perf_counter() - wall
+            self.cpu[name] = self.cpu.get(name, 0.0) + \
+                time.process_time() - cpu
+
+    def count(self, name, n=1):
+        """Add n to the counter."""
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def to_dict(self):
+        return {
+            'wall': dict(self.wall),
+            'cpu': dict(self.cpu),
+            'counters': dict(self.counters)
+        }
+
+
+def percentile(values, p):
+    """The p-th percentile of the sorted values (nearest rank)."""
+    if not values:
+        return None
+
+    rank = max(int(-(-p * len(values) // 100)), 1)  # ceil
+    return values[min(rank, len(values)) - 1]
+
+
+class Report:
+    """The stats of the documents in a run."""
+
+    percentiles = (50, 90, 99)
+
+    def __init__(self):
+        self.documents = []
+
+    def add(self, fn, status, stats=None):
+        """Add the stats (Stats.to_dict()) of a document."""
+        doc = {'file': str(fn), 'status': status}
+        if stats is not None:
+            doc.update(stats)
+        self.documents.append(doc)
+
+    def summary(self):
+        """Summarize the timings and the counters over the documents.
+
+        Returns:
+            A list of dictionaries with the keys 'metric', 'kind' ('wall',
+            'cpu' or 'counters'), 'n', 'total', 'mean', 'p50', 'p90', 'p99'
+            and 'max'.
+        """
+        rows = []
+        for kind in ('wall', 'cpu', 'counters'):
+            values = {}
+            for doc in self.documents:
+                for metric, value in doc.get(kind, {}).items():
+                    values.setdefault(metric, []).append(value)
+
+            for metric in sorted(values):
+                vs = sorted(values[metric])
+                row = {
+                    'metric': metric,
+                    'kind': kind,
+                    'n': len(vs),
+                    'total': sum(vs),
+                    'mean': sum(vs) / len(vs),
+                }
+                for p in Report.percentiles:
+                    row['p{}'.format(p)] = percentile(vs, p)
+                row['max'] = vs[-1]
+                rows.append(row)
+
+        return rows
+
+    def dump(self, fn):
+        """Write the report to the file.
+
+        If the filename ends with '.json', the report is written in JSON
+        with the stats of each document. Otherwise the summary is written in
+        TSV.
+        """
+        fn = str(fn)
+        if fn.endswith('.json'):
+            with open(fn, 'w') as f:
+                json.dump({
+                    'summary': self.summary(),
+                    'documents': self.documents
+                }, f, indent=1)
+            return
+
+        columns = ['metric', 'kind', 'n', 'total', 'mean'] + [
+            'p{}'.format(p) for p in Report.percentiles
+        ] + ['max']
+        with open(fn, 'w', newline='') as f:
+            writer = csv.DictWriter(
+                f, columns, delimiter='\t', lineterminator='\n')
+            writer.writeheader()
+            for row in self.summary():
+                writer.writerow({
+                    k: '{:.6f}'.format(v) if isinstance(v, float) else v
+                    for k, v in row.items()
+                })
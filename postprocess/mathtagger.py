@@ -5,17 +5,19 @@ import os
 import sys
 import re
 import html
+import time
 import subprocess
+import multiprocessing
 import pycrfsuite
 from tempfile import TemporaryDirectory, NamedTemporaryFile
 from pathlib import Path
 from docopt import docopt
-from lxml import etree
 
-from .config import PKG_NAME, VERSION
+from .config import PKG_NAME, VERSION, MODEL_FILE, CACHE_DIR
 from .exceptions import AlreadyTaggedError
 from .cli_utils import set_logger
-from .structures import Document
+from .structures import Document, set_parser
+from .compression import base_name
 
 # help text
 MOD_NAME = "{}.mathtagger".format(PKG_NAME)
@@ -31,10 +33,17 @@ Usage:
 
 Options:
     -h, --help             Show this screen and exit.
+    -c DIR, --cache=DIR    Cache the features for learning in DIR.
     -F, --force            Ignore embedded math tags.
+    -j N, --jobs=N         Extract the features for learning with N
+                           processes; 0 means the number of CPUs
+                           [default: 1].
     -l FILE, --log=FILE    Output messages to FILE.
     -m FILE, --model=FILE  Use FILE as model file.
+    --no-cache             Do not use nor update the cache of the features.
     -o DIR, --out=DIR      Output files to DIR.
+    --parser=NAME          Parse the XHTML with the parser NAME: 'tuned',
+                           'compact' or 'default' [default: tuned].
     -q, --quiet            Show less messages.
     -v, --verbose          Show more messages.
     -V, --version          Show version.
@@ -49,6 +58,17 @@ logger = getLogger('postprocess')
 class MathTagger:
     ns = {'x': 'http://www.w3.org/1999/xhtml'}
 
+    # pycrfsuite taggers shared in the process, keyed by the model file
+    taggers = {}
+
+    # offsets of the words whose features are used for a word
+    window = (-3, -2, -1, 0, 1, 2, 3)
+
+    # the version of the features; change it when the features change, to
+    # invalidate the cached training data
+    feature_version = '1'
+    whitespace = re.compile(r'\s+')
+
     def __init__(self, modelfile, force=False):
         """The constructor
 
@@ -68,18 +88,22 @@ class MathTagger:
 
         logger.info('MathTagger initialized.')
 
-    def open(self, doc):
+    def open(self, doc, fonts=None):
         """Open a XHTML file.
 
         Args:
             doc (Document): The input document.
+            fonts (FontStats): The fonts of the whole document, when the
+                document is tagged section by section. If None, the fonts
+                in the document are counted.
         """
         self.doc = doc
         self.docid = self.__get_docid()
         self.fontspecs = self.__get_fontspecs()
         self.mathtags = None
-        self.__get_equation_and_main_fonts()
-        self.__get_feature_list()
+        with doc.stats.stage('math.features'):
+            self.__get_equation_and_main_fonts(fonts)
+            self.__get_feature_list()
         logger.info('Now docid = {}'.format(self.docid))
 
     def tag(self, force=None):
@@ -96,31 +120,21 @@ class MathTagger:
         if force is None:
             force = self.force
 
+        tagged = [
+            word for word in self.doc.layout.spans
+            if 'data-math' in word.attrib
+        ]
         if not force:
-            if len(
-                    self.doc.tree.xpath(
-                        'x:body/x:div/x:div/x:p/x:span[@data-math]',
-                        namespaces=MathTagger.ns)) > 0:
+            if len(tagged) > 0:
                 raise AlreadyTaggedError
 
         # Clear embedded 'data-math' attributes
-        for word in self.doc.tree.xpath(
-                'x:body/x:div/x:div/x:p/x:span[@data-math]',
-                namespaces=MathTagger.ns):
+        for word in tagged:
             del word.attrib['data-math']
 
         # Set tagger
-        if self.tagger is None:
-            if os.path.isfile(self.modelfile) is not True:
-                logger.error(
-                    'The modelfile {} is not exist or readable'.format(
-                        self.modelfile))
-                return False
-
-            self.tagger = pycrfsuite.Tagger()
-            self.tagger.open(self.modelfile)
-            logger.info("A tagger instance is created from '{}'".format(
-                self.modelfile))
+        if self.load() is None:
+            return False
 
         # Create data list
         xseq = []
@@ -129,27 +143,59 @@ class MathTagger:
             p_id = paragraph["id"]
             for word in paragraph["words"]:
                 w_id, spell, start, end, features = word
-                f = re.split(r'\s+', features)
-                f.remove('')
-                xseq.append(f)
+                xseq.append(features)
                 wids.append(w_id)
 
         # Execute `crfsuite` in tag mode
-        yseq = self.tagger.tag(xseq)
+        stats = self.doc.stats
+        with stats.stage('math.crf'):
+            yseq = self.tagger.tag(xseq)
 
         total = 0
         for i in range(len(wids)):
             if yseq[i] == 'O':
                 continue
-            for word_element in self.doc.tree.xpath(
-                    '//x:span[@id="{}"]'.format(wids[i]),
-                    namespaces=MathTagger.ns):
+            word_element = self.doc.get_element_by_id(wids[i])
+            if word_element is not None:
                 word_element.attrib['data-math'] = yseq[i]
                 total += 1
 
+        stats.count('math.paragraphs', len(self.feature_list))
+        stats.count('math.words', len(xseq))
+        stats.count('math.tags', total)
+
         logger.info("Embed {} data-math tags.".format(total))
         return total
 
+    def load(self):
+        """Load the model file into the tagger.
+
+        The tagger is shared by all MathTaggers in the process which use the
+        same model file, so the model is read only once. Loading it before
+        forking worker processes lets them share the loaded model.
+
+        Returns:
+            The pycrfsuite.Tagger, or None if the model file is not readable.
+        """
+        if self.tagger is not None:
+            return self.tagger
+
+        if self.modelfile not in MathTagger.taggers:
+            if os.path.isfile(self.modelfile) is not True:
+                logger.error(
+                    'The modelfile {} is not exist or readable'.format(
+                        self.modelfile))
+                return None
+
+            tagger = pycrfsuite.Tagger()
+            tagger.open(self.modelfile)
+            MathTagger.taggers[self.modelfile] = tagger
+            logger.info("A tagger instance is created from '{}'".format(
+                self.modelfile))
+
+        self.tagger = MathTagger.taggers[self.modelfile]
+        return self.tagger
+
     def outputXhtml(self, filename=None):
         """Write xhtml to the file.
 
@@ -157,41 +203,79 @@ class MathTagger:
         """
         if filename is None:
             logger.info("Output xhtml to stdout")
-            sys.stdout.buffer.write(etree.tostring(self.doc.tree))
+            self.doc.write(sys.stdout.buffer)
         else:
             logger.info("Output xhtml to '{}'".format(filename))
             with open(filename, 'w+b') as fp:
-                fp.write(etree.tostring(self.doc.tree))
+                self.doc.write(fp)
+
+    def get_training_data(self):
+        """Get the training data of the opened document.
+
+        Returns:
+            A list of (xseq, yseq) for each paragraph, where xseq is the list
+            of the features of the words, and yseq is the list of their
+            'data-math' labels ('O' if not labeled).
+        """
+        data = []
+        for paragraph in self.feature_list:
+            words = paragraph["words"]
+            if not words:
+                continue
+
+            xseq = [word[4] for word in words]
+            yseq = [self.__get_mathtag(word[0]) for word in words]
+            data.append((xseq, yseq))
+
+        return data
 
     @staticmethod
-    def learn(xhtml_files, modelfile):
+    def learn(xhtml_files, modelfile, jobs=1, cache=None):
         """Learn model from the XHTML files.
-        """
-        mathtagger = MathTagger(modelfile, False)
-        xseq = []
-        yseq = []
 
-        for xhtml_file in xhtml_files:
-            logger.info("Reading '{}'".format(xhtml_file))
-            fn = Path(xhtml_file)
+        The features are extracted by 'jobs' worker processes, and each
+        paragraph is given to the trainer as a sequence, in the order of the
+        files.
 
-            doc = Document(str(fn))
-            mathtagger.open(doc)
-            for paragraph in mathtagger.__get_feature_list():
-                for word in paragraph["words"]:
-                    w_id, spell, start, end, features = word
-                    mathtag = mathtagger.__get_mathtag(w_id)
-                    f = re.split(r'\s+', features)
-                    f.remove('')
-                    xseq.append(f)
-                    yseq.append(mathtag)
+        Args:
+            xhtml_files (list): The training XHTML files with 'data-math'
+            modelfile (str): The model file to write
+            jobs (int): The number of the worker processes
+            cache (FeatureCache): The cache of the features, or None
+        """
+        trainer = Trainer()
+        n_files = len(xhtml_files)
+        n_words = 0
+        start = time.perf_counter()
+
+        def append(results):
+            nonlocal n_words
+            for i, (fn, data, elapsed, cached) in enumerate(results):
+                for xseq, yseq in data:
+                    trainer.append(xseq, yseq)
+                    n_words += len(xseq)
+                logger.info("[{}/{}] {} {} paragraphs from '{}' "
+                            "in {:.2f} sec".format(
+                                i + 1, n_files,
+                                'Loaded' if cached else 'Extracted',
+                                len(data), fn, elapsed))
+
+        tasks = [(fn, cache) for fn in xhtml_files]
+        if jobs > 1:
+            ctx = multiprocessing.get_context('fork')
+            with ctx.Pool(jobs) as pool:
+                append(pool.imap(extract_training_data, tasks))
+        else:
+            append(map(extract_training_data, tasks))
+
+        logger.info('Extracted the features of {} words in {:.2f} sec'.format(
+            n_words, time.perf_counter() - start))
 
         # Execute train
-        trainer = pycrfsuite.Trainer()
-        trainer.append(xseq, yseq)
+        start = time.perf_counter()
         trainer.train(modelfile)
-
-        return
+        logger.info('Trained the model in {:.2f} sec'.format(
+            time.perf_counter() - start))
 
     @staticmethod
     def __get_fontkey_from_fontspec(fontspec):
@@ -216,6 +300,33 @@ class MathTagger:
             return True
         return False
 
+    @staticmethod
+    def __format_features(feature):
+        """Format the features of a word as crfsuite attributes.
+
+        The attributes are formatted as 'name[offset]=value' for each offset
+        in the window. As in the crfsuite data format, whitespaces in a value
+        separate attributes.
+
+        Returns:
+            A dictionary from the offset to the list of attributes.
+        """
+        items = [(k, str(v)) for k, v in feature.items() if k not in ("id", )]
+        split = any(MathTagger.whitespace.search(v) for k, v in items)
+
+        formatted = {}
+        for i in MathTagger.window:
+            offset = '[{0:d}]='.format(i)
+            attrs = [k + offset + v for k, v in items]
+            if split:
+                attrs = [
+                    a for attr in attrs
+                    for a in MathTagger.whitespace.split(attr) if a
+                ]
+            formatted[i] = attrs
+
+        return formatted
+
     def __get_docid(self):
         """Get docid from the document element.
         """
@@ -246,8 +357,7 @@ class MathTagger:
         """
         if self.mathtags is None:
             self.mathtags = {}
-            for word in self.doc.tree.xpath(
-                    'x:body/x:div/x:div/x:p/x:span', namespaces=MathTagger.ns):
+            for word in self.doc.layout.spans:
 
                 if 'id' not in word.attrib or 'data-math' not in word.attrib:
                     continue
@@ -259,10 +369,11 @@ class MathTagger:
 
         return 'O'
 
-    def __get_equation_and_main_fonts(self):
+    def __get_equation_and_main_fonts(self, fonts=None):
         """Count the frequency of fonts that appear in sentences.
 
-        The most frequent font is the 'main font' (return value).
+        The most frequent font is the 'main font' (return value). The fonts
+        are counted in the document unless 'fonts' (FontStats) is given.
 
         The fonts and words appears in 'Equation' blocks are
         stored in instance variables.
@@ -279,52 +390,28 @@ class MathTagger:
         # fontspecs = self.get_fontspecs()
 
         # Count font frequency
-        font_freqs = {}
-        self.equation_fonttypes = set()
-        self.equation_spells = set()
-        self.equation_font_spells = {}
-        for box in self.doc.tree.xpath(
-                'x:body/x:div/x:div', namespaces=MathTagger.ns):
-            for word in box.xpath('x:p/x:span', namespaces=MathTagger.ns):
-                if 'data-ftype' not in word.attrib:
-                    continue
-
-                ftype = word.attrib['data-ftype']
-                w = word.text
-
-                if 'data-name' in box.attrib \
-                        and box.attrib['data-name'] == 'Equation':
-                    self.equation_fonttypes.add(ftype)
-                    self.equation_spells.add(w)
-                    if ftype not in self.equation_font_spells:
-                        self.equation_font_spells[ftype] = set()
-                    self.equation_font_spells[ftype].add(w)
-
-                if ftype not in font_freqs:
-                    font_freqs[ftype] = 0
-                font_freqs[ftype] += 1
+        if fonts is None:
+            fonts = FontStats()
+            fonts.add(self.doc)
 
-        maxfreq = -1
-        self.mainfont = None
-        for ftype, freq in font_freqs.items():
-            if freq > maxfreq:
-                self.mainfont = ftype
-                maxfreq = freq
+        self.equation_fonttypes = fonts.equation_fonttypes
+        self.equation_spells = fonts.equation_spells
+        self.equation_font_spells = fonts.equation_font_spells
+        self.mainfont = fonts.mainfont()
 
         return self.mainfont
 
     def __get_feature_list(self):
-        for box in self.doc.tree.xpath(
-                'x:body/x:div/x:div', namespaces=MathTagger.ns):
-            boxtype = box.attrib['data-name']
+        for box in self.doc.layout.boxes:
+            boxtype = box.name
             if boxtype.lower() not in ('title', 'abstract', 'body', 'listitem',
                                        'caption'):
                 continue
 
-            for paragraph in box.xpath('x:p', namespaces=MathTagger.ns):
+            for paragraph in box.paragraphs:
                 may_math_paragraph = False
 
-                p_id = paragraph.attrib['id']
+                p_id = paragraph.node.attrib['id']
                 p_text = ''
                 p_cursor = 0
                 position_map = {}
@@ -333,8 +420,7 @@ class MathTagger:
                 is_url = False
 
                 # Get word information
-                for word in paragraph.xpath(
-                        'x:span', namespaces=MathTagger.ns):
+                for word in paragraph.spans:
                     if 'data-ftype' not in word.attrib:
                         continue
                     if word.text is None:
@@ -405,18 +491,20 @@ class MathTagger:
                 else:
                     is_equation = 'N'
 
+                # Format the features of each word once per offset
+                formatted = [
+                    self.__format_features(feature) for feature in features
+                ]
+
                 paragraph_features = []
                 for wi in range(len(features)):
                     feature = features[wi]
                     w_id = feature['id']
-                    f = ''
-                    for i in [-3, -2, -1, 0, 1, 2, 3]:
+                    f = []
+                    for i in MathTagger.window:
                         if wi + i < 0 or wi + i >= len(features):
                             continue
-                        feature2 = features[wi + i]
-                        for k, v in feature2.items():
-                            if k not in ("id", ):
-                                f += "{0:s}[{1:d}]={2} ".format(k, i, v)
+                        f.extend(formatted[wi + i][i])
 
                     paragraph_features.append([
                         w_id, feature['w'], position_map[w_id][0],
@@ -432,6 +520,123 @@ class MathTagger:
         return self.feature_list
 
 
+class FontStats:
+    """The frequency of the fonts in a document, and the fonts and the words
+    in its 'Equation' blocks.
+
+    The fonts can be counted section by section, by adding the sections in
+    order.
+
+    Attributes:
+        font_freqs (dict): The frequency of each fonttype
+        equation_fonttypes (set): Fonttypes in equation blocks
+        equation_spells (set): Word notations in equation blocks
+        equation_font_spells (dict): Fonttypes with notations in equation
+            blocks
+    """
+
+    def __init__(self):
+        self.font_freqs = {}
+        self.equation_fonttypes = set()
+        self.equation_spells = set()
+        self.equation_font_spells = {}
+
+    def add(self, doc):
+        """Count the fonts of the words in the document."""
+        for box in doc.layout.boxes:
+            for word in (w for p in box.paragraphs for w in p.spans):
+                if 'data-ftype' not in word.attrib:
+                    continue
+
+                ftype = word.attrib['data-ftype']
+                w = word.text
+
+                if box.name == 'Equation':
+                    self.equation_fonttypes.add(ftype)
+                    self.equation_spells.add(w)
+                    if ftype not in self.equation_font_spells:
+                        self.equation_font_spells[ftype] = set()
+                    self.equation_font_spells[ftype].add(w)
+
+                if ftype not in self.font_freqs:
+                    self.font_freqs[ftype] = 0
+                self.font_freqs[ftype] += 1
+
+    def mainfont(self):
+        """Get the most frequent font (the 'main font')."""
+        maxfreq = -1
+        mainfont = None
+        for ftype, freq in self.font_freqs.items():
+            if freq > maxfreq:
+                mainfont = ftype
+                maxfreq = freq
+
+        return mainfont
+
+
+class Trainer(pycrfsuite.Trainer):
+    """The pycrfsuite trainer which reports the progress to the logger.
+
+    The messages of crfsuite go to the logger instead of the stdout.
+    """
+
+    def on_start(self, log):
+        logger.debug(log.rstrip())
+
+    def on_featgen_progress(self, log, percent):
+        pass
+
+    def on_featgen_end(self, log):
+        logger.debug(log.rstrip())
+
+    def on_prepared(self, log):
+        logger.debug(log.rstrip())
+
+    def on_prepare_error(self, log):
+        logger.error(log.rstrip())
+
+    def on_iteration(self, log, info):
+        logger.info('Iteration {}: loss {:.4f} ({:.3f} sec)'.format(
+            info['num'], info['loss'], info['time']))
+
+    def on_optimization_end(self, log):
+        logger.debug(log.rstrip())
+
+    def on_end(self, log):
+        logger.debug(log.rstrip())
+
+
+def extract_training_data(task):
+    """Extract the training data of a XHTML file, or load it from the cache.
+
+    This is the unit of work of the worker processes in MathTagger.learn.
+
+    Args:
+        task (tuple): (fn, cache)
+
+    Returns:
+        A tuple (fn, data, elapsed, cached), where data is the result of
+        MathTagger.get_training_data.
+    """
+    fn, cache = task
+    start = time.perf_counter()
+
+    if cache is not None:
+        key = cache.key(fn)
+        data = cache.load(key)
+        if data is not None:
+            return fn, data, time.perf_counter() - start, True
+
+    mathtagger = MathTagger(None)
+    mathtagger.open(Document(str(fn)))
+    data = mathtagger.get_training_data()
+
+    if cache is not None:
+        cache.store(key, data)
+
+    return fn, data, time.perf_counter() - start, False
+
+
 def mathtagger_cui():
     """The test function
     """
@@ -449,9 +654,16 @@ def mathtagger_cui():
 
     set_logger(log_level, log_file)
 
+    # the parser
+    try:
+        set_parser(args['--parser'])
+    except ValueError as e:
+        logger.error(e)
+        sys.exit(1)
+
     # model file
     if args['--model'] is None:
-        modelfile = 'postprocess/mathtagger/model/inline_math.model'
+        modelfile = MODEL_FILE
     else:
         modelfile = args['--model']
 
@@ -474,12 +686,21 @@ def mathtagger_cui():
             if args['--out']:
                 out_dir = Path(args['--out'])
                 out_dir.mkdir(parents=True, exist_ok=True)
-                mathtagger.outputXhtml(str(out_dir / fn.name))
+                mathtagger.outputXhtml(str(out_dir / base_name(fn).name))
             else:
                 mathtagger.outputXhtml()
 
     # the "learn" operation
     elif args['learn']:
+        # check the options before touching the model file
+        try:
+            jobs = int(args['--jobs'])
+        except ValueError:
+            logger.error('Invalid number of jobs: {}'.format(args['--jobs']))
+            sys.exit(1)
+        if jobs <= 0:
+            jobs = os.cpu_count() or 1
+
         if os.path.isfile(modelfile):
             # Backup file
             import shutil
@@ -487,8 +708,17 @@ def mathtagger_cui():
             date = datetime.datetime.now().date().isoformat()
             shutil.copy(modelfile, modelfile + "." + date)
 
+        # the cache of the features
+        if args['--no-cache']:
+            cache = None
+        else:
+            from .cache import FeatureCache
+            cache_dir = args['--cache'] or os.path.join(CACHE_DIR, 'features')
+            cache = FeatureCache(cache_dir, MathTagger.feature_version)
+            logger.debug('Using the feature cache: {}'.format(cache_dir))
+
         # Learn model from the XHTML files
-        MathTagger.learn(args['XHTML'], modelfile)
+        MathTagger.learn(args['XHTML'], modelfile, jobs, cache)
 
 
 if __name__ == '__main__':
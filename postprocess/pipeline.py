@@ -0,0 +1,496 @@
+"""
+The Pipeline module.
+
+A pipeline runs the stages of postprocess on a document in order:
+
+    1. figure tagging (FigureTagger)
+    2. math tagging (MathTagger)
+    3. citation detection (CiteDetector)
+    4. textualization (Textualizer)
+
+Use process() to run the pipeline on a XHTML in memory, and process_file()
+to process a file and output the result files, or append them into the
+shards of an archive (see archive.py), and the tables into a SQLite database
+(see database.py). Very large files can be
+processed section by section with Pipeline.run_stream (see stream.py).
+
+The stages are created once (in each thread) and reused for all documents.
+In particular, the CRF model of the MathTagger is loaded when the pipeline
+is created.
+The time spent in each stage is recorded in the stats of the document.
+"""
+
+# libraries
+import io
+import csv
+import threading
+from pathlib import Path
+from collections import defaultdict, deque
+
+from .config import MODEL_FILE
+from .exceptions import AlreadyTaggedError
+from .structures import Document
+from .stream import StreamDocument
+from .compression import base_name, open_file
+from .archive import get_archive
+from .database import get_database
+from .figuretagger import FigureTagger
+from .mathtagger import MathTagger, FontStats
+from .citedetector import CiteDetector
+from .textualizer import Textualizer, TextBuilder
+
+# use logger
+from logging import getLogger
+logger = getLogger('postprocess')
+
+
+# the module
+class Pipeline:
+    """The sequence of the postprocess stages."""
+
+    def __init__(self, model_file=MODEL_FILE):
+        """Initialize the stages and load the math model.
+
+        Args:
+            model_file (str): The model file of the MathTagger
+        """
+        self.figuretagger = FigureTagger()
+        self.mathtagger = MathTagger(model_file)
+        self.citedetector = CiteDetector()
+        self.textualizer = Textualizer()
+
+        self.mathtagger.load()
+
+    def run(self, doc, remove_pos=True):
+        """Run all stages on the document.
+
+        Args:
+            doc (Document): The input document
+            remove_pos (bool): Whether remove positions or not
+
+        Returns:
+            The processed document.
+        """
+        stats = doc.stats
+
+        # figure tagging
+        with stats.stage('figure'):
+            self.figuretagger.tag(doc)
+
+        # math tagging
+        with stats.stage('math'):
+            self.mathtagger.open(doc)
+
+            try:
+                self.mathtagger.tag()
+
+            except AlreadyTaggedError:
+                logger.warn(
+                    'mathtagger: File "{}" is already math-tagged. Skipping'.
+                    format(doc.filename))
+
+        # citation detection
+        with stats.stage('cite'):
+            self.citedetector.open(doc)
+            self.citedetector.detect_cite()
+
+        # textualize
+        with stats.stage('text'):
+            self.textualizer.textualize(doc, remove_pos)
+
+        return doc
+
+    def run_stream(self, doc, remove_pos=True):
+        """Run all stages on the document section by section.
+
+        The state of the whole document is collected by the first pass over
+        the sections. Then the stages run on each section in the second
+        pass, and the sections are released as soon as the textualizer
+        closes their paragraphs.
+
+        Args:
+            doc (StreamDocument): The input document
+            remove_pos (bool): Whether remove positions or not
+
+        Returns:
+            The processed document.
+        """
+        stats = doc.stats
+
+        # the first pass
+        figures = defaultdict(int)
+        fonts = FontStats()
+        references = []
+        continued = {}
+        tagged = False
+        n_pars = 0
+        with stats.stage('scan'):
+            for section in doc.sections():
+                self.figuretagger.find_figures(doc, figures)
+                fonts.add(doc)
+                references.extend({
+                    'id': ref['id'],
+                    'text': ref['text']
+                } for ref in CiteDetector.split_references(doc)[0])
+
+                for p in doc.layout.paragraphs:
+                    continued_from = p.node.get('data-continued-from')
+                    if continued_from:
+                        continued[continued_from] = n_pars
+                    n_pars += 1
+
+                tagged = tagged or any('data-math' in w.attrib
+                                       for w in doc.layout.spans)
+                doc.discard(section.node)
+
+        stats.count('figure.figures', len(figures))
+        stats.count('cite.references', len(references))
+
+        if tagged and not self.mathtagger.force:
+            logger.warn(
+                'mathtagger: File "{}" is already math-tagged. Skipping'.
+                format(doc.filename))
+
+        # the second pass
+        builder = TextBuilder(self.textualizer, stats, continued)
+        pending = deque()
+
+        def release(final=False):
+            builder.close(final)
+            while pending and pending[0][2] < builder.n_closed:
+                section, spans, _ = pending.popleft()
+                builder.flush(spans)
+                if remove_pos:
+                    self.textualizer.remove_positions(section.node)
+                doc.release(section.node)
+
+        for section in doc.sections():
+            with stats.stage('figure'):
+                self.figuretagger.tag(doc, figures)
+
+            if not tagged or self.mathtagger.force:
+                with stats.stage('math'):
+                    self.mathtagger.open(doc, fonts)
+                    self.mathtagger.tag()
+
+            with stats.stage('cite'):
+                self.citedetector.open(doc, references)
+                self.citedetector.detect_cite()
+
+            with stats.stage('text'):
+                last = builder.add_section(section)
+                pending.append((section, doc.layout.spans, last))
+                release()
+
+        with stats.stage('text'):
+            release(final=True)
+            builder.finish(doc)
+
+        doc.close()
+        return doc
+
+
+def output_files(src, out_dir, compress=None):
+    """Get the paths of the result files.
+
+    The suffix of the compression of the input is not a part of the names,
+    and that of the output is appended to them (e.g., paper.word.tsv.gz for
+    paper.xhtml.xz).
+
+    Args:
+        src (Path): The input file
+        out_dir (Path): The output directory
+        compress (str): The compression method of the results, or None
+
+    Returns:
+        A dictionary from the kind of the result to the path.
+    """
+    src = base_name(src)
+    suffix = '.' + compress if compress else ''
+    return {
+        'word.tsv': out_dir / Path(src.stem + '.word.tsv' + suffix),
+        'xhtml': out_dir / Path(src.name + suffix),
+        'txt': out_dir / Path(src.stem + '.txt' + suffix),
+        'sent.tsv': out_dir / Path(src.stem + '.sent.tsv' + suffix),
+        'math.tsv': out_dir / Path(src.stem + '.math.tsv' + suffix),
+        'cite.tsv': out_dir / Path(src.stem + '.cite.tsv' + suffix),
+    }
+
+
+def is_up_to_date(src, out_dir, depends=(), compress=None):
+    """Check whether the result files are up to date, as make does.
+
+    The results are up to date if all of them exist and none of them is
+    older than the input file and the dependencies (e.g., the model file).
+
+    Args:
+        src (Path): The input file
+        out_dir (Path): The output directory
+        depends (iterable): The other files which the results depend on
+        compress (str): The compression method of the results, or None
+
+    Returns:
+        True if the results are up to date.
+    """
+    try:
+        oldest = min(path.stat().st_mtime
+                     for path in output_files(src, out_dir, compress).values())
+        newest = max(
+            Path(str(fn)).stat().st_mtime for fn in [src] + list(depends))
+    except OSError:
+        return False
+
+    return newest <= oldest
+
+
+def output(doc, out_dir, compress=None, archive=None, database=None):
+    """Output the result files.
+
+    Args:
+        doc (Document): The processed document
+        out_dir (Path): The output directory
+        compress (str): The compression method of the results, or None
+        archive (ArchiveWriter): Append the results into the shards of the
+            archive instead of the files, or None
+        database (Database): Write the words, the sentences, the maths and
+            the cites into the database instead of the TSV files, or None
+    """
+
+    # general preparation
+    logger.debug('Outputting the results into {}'.format(out_dir))
+    out_dir.mkdir(parents=True, exist_ok=True)
+    src = Path(doc.filename)
+
+    def get_writer(f):
+        return csv.writer(
+            f,
+            delimiter='\t',
+            quotechar='"',
+            lineterminator='\n',
+            quoting=csv.QUOTE_MINIMAL)
+
+    files = output_files(src, out_dir, compress)
+
+    def open_output(kind, mode, **kwargs):
+        if archive is None:
+            return open_file(files[kind], mode, compress, **kwargs)
+        return archive.open(kind, files[kind].name, mode, compress, **kwargs)
+
+    if archive is not None:
+        archive.begin(base_name(src).stem)
+
+    # xhtml
+    xhtml = files['xhtml']
+    logger.debug('Writing {}'.format(xhtml))
+    if compress is None and archive is None:
+        doc.write(str(xhtml))
+    else:
+        with open_output('xhtml', 'wb') as f:
+            doc.write(f)
+
+    # plain text
+    txt = files['txt']
+    logger.debug('Writing {}'.format(txt))
+    with open_output('txt', 'wt', encoding='utf-8') as f:
+        f.write(doc.text)
+
+    # the tables
+    if database is not None:
+        logger.debug('Writing the tables into {}'.format(database.filename))
+        database.store(doc, doc.docid or base_name(src).stem, str(src))
+
+    else:
+        # word.tsv
+        word_tsv = files['word.tsv']
+        logger.debug('Writing {}'.format(word_tsv))
+
+        with open_output('word.tsv', 'wt', newline='') as f:
+            writer = get_writer(f)
+            writer.writerow(['ID', 'From', 'To', src])
+            words = doc.words
+            writer.writerows(zip(words.ids, words.starts, words.ends))
+
+        # sent.tsv
+        sent_tsv = files['sent.tsv']
+        logger.debug('Writing {}'.format(sent_tsv))
+
+        with open_output('sent.tsv', 'wt', newline='') as f:
+            writer = get_writer(f)
+            writer.writerow(['id', 'sect_name', 'box_name', 'text', 'words'])
+            for s in doc.sentences:
+                writer.writerow([
+                    s._id, s.sec_name, s.box_name,
+                    s.text.strip(), ','.join(s.words)
+                ])
+
+        # math.tsv
+        math_tsv = files['math.tsv']
+        logger.debug('Writing {}'.format(math_tsv))
+
+        with open_output('math.tsv', 'wt', newline='') as f:
+            writer = get_writer(f)
+            writer.writerow(
+                ['MathID', 'StartID', 'EndId', 'Page', 'X1', 'Y1', 'X2', 'Y2'])
+            for m in doc.maths:
+                writer.writerow(m)
+
+        # cite.tsv
+        cite_tsv = files['cite.tsv']
+        logger.debug('Writing {}'.format(cite_tsv))
+
+        with open_output('cite.tsv', 'wt', newline='') as f:
+            writer = get_writer(f)
+            writer.writerow(['CiteID', 'Text', 'From'])
+            for c in doc.cites:
+                writer.writerow([c[0], c[1], ','.join(c[2])])
+
+    if archive is not None:
+        archive.commit()
+
+
+# the pipelines of each thread, keyed by the model file; the stages keep
+# the state of the document in process, so a pipeline is not shared by the
+# threads
+pipelines = threading.local()
+
+
+def get_pipeline(model_file=MODEL_FILE):
+    """Get the pipeline of the current thread for the model file.
+
+    The pipeline is created on the first call in each thread. Call this
+    before forking worker processes so that they inherit the loaded model.
+    """
+    pool = pipelines.__dict__
+    if model_file not in pool:
+        pool[model_file] = Pipeline(model_file)
+
+    return pool[model_file]
+
+
+def process_file(fn,
+                 out_dir,
+                 remove_pos=True,
+                 cache=None,
+                 incremental=False,
+                 stream=False,
+                 compress=None,
+                 archive=None,
+                 database=None):
+    """Process a XHTML file and output the results.
+
+    Args:
+        fn (Path): The input file
+        out_dir (Path): The output directory
+        remove_pos (bool): Whether remove positions or not
+        cache (ResultCache): The result cache, or None to disable it
+        incremental (bool): Skip the file if the results are up to date
+        stream (bool): Read the file section by section to save memory
+        compress (str): The compression method of the results, or None
+        archive (int): Append the results into the archive in out_dir, in
+            shards of this number of documents, instead of the files; the
+            cache and the incremental mode are not used. None to write the
+            files.
+        database (str): Write the words, the sentences, the maths and the
+            cites into the SQLite database file instead of the TSV files;
+            the cache and the incremental mode are not used. None to write
+            the files.
+
+    Returns:
+        The processed document, or None if the results are up to date or
+        restored from the cache.
+    """
+    if archive is not None:
+        archive = get_archive(out_dir, archive)
+        incremental = False
+        cache = None
+    if database is not None:
+        database = get_database(database)
+        incremental = False
+        cache = None
+
+    # skip the file whose results are newer than the input and the model
+    if incremental and is_up_to_date(fn, out_dir, [MODEL_FILE], compress):
+        logger.info('The results are up to date: {}'.format(fn))
+        return None
+
+    # skip the file whose results are cached
+    if cache is not None:
+        key = cache.key(fn, remove_pos, stream, compress)
+        if cache.restore(key, fn, out_dir, compress):
+            logger.info('Using the cached results: {}'.format(fn))
+            return None
+
+    logger.info('Begin to process: {}'.format(fn))
+
+    # load the xhtml, and run the stages shared in the process
+    if stream:
+        doc = StreamDocument(str(fn))
+        get_pipeline().run_stream(doc, remove_pos)
+    else:
+        doc = Document(str(fn))
+        get_pipeline().run(doc, remove_pos)
+
+    # output the results
+    with doc.stats.stage('output'):
+        output(doc, out_dir, compress, archive, database)
+
+    if cache is not None:
+        cache.store(key, fn, out_dir, compress)
+
+    return doc
+
+
+class Result:
+    """The results of a document processed in memory.
+
+    Attributes:
+        docid (str): The docid in head/meta, or None if not defined
+        words (WordTable): The words; iterate it for (id, from, to)
+        sentences (list): The sentences (Sentence)
+        maths (list): (math id, start id, end id, page, x1, y1, x2, y2) of
+            the maths
+        cites (list): (cite id, text, ids of the citing words) of the
+            references
+        text (str): The plain text
+        xhtml (bytes): The serialized XHTML
+        stats (dict): The timings and the counters of the stages
+    """
+
+    def __init__(self, doc):
+        self.docid = doc.docid
+        self.words = doc.words
+        self.sentences = doc.sentences
+        self.maths = doc.maths
+        self.cites = doc.cites
+        self.text = doc.text
+
+        with doc.stats.stage('output'):
+            f = io.BytesIO()
+            doc.write(f)
+            self.xhtml = f.getvalue()
+
+        self.stats = doc.stats.to_dict()
+
+
+def process(xhtml, remove_pos=True, model_file=MODEL_FILE, name='<memory>'):
+    """Process a XHTML in memory, without reading or writing any file.
+
+    It runs the same stages as the command line, with the pipeline of the
+    current thread, so it can be called from several threads at once; each
+    thread loads the math model on its first call.
+
+    Args:
+        xhtml (bytes): The input XHTML
+        remove_pos (bool): Whether remove positions or not
+        model_file (str): The model file of the MathTagger
+        name (str): The name of the document in the messages
+
+    Returns:
+        The Result of the document.
+    """
+    doc = Document(io.BytesIO(xhtml))
+    doc.filename = name
+
+    get_pipeline(model_file).run(doc, remove_pos)
+
+    return Result(doc)
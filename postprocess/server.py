@@ -0,0 +1,247 @@
+"""
+The server mode.
+
+The server keeps the stages and the math model loaded, and processes the
+jobs sent over HTTP, on localhost or on a UNIX socket. The jobs are
+processed by a pool of worker processes, which are forked after the model
+is loaded.
+
+The API:
+
+    GET /status
+        Returns {"version": ..., "workers": N}.
+
+    POST /process
+        Takes a JSON object {"input": XHTML, "out": DIR, "map": false}.
+        "out" (the output directory of the server by default) and "map"
+        (insert positions into the xhtml) are optional. Returns a JSON
+        object with the keys:
+
+            "input": the input file
+            "status": "done", "skipped" or "failed"
+            "outputs": the paths of the result files, keyed by the kind
+            "stats": the timings and the counters of the stages (or null)
+            "elapsed": the wall time of the job in seconds
+            "error": the error message (only if failed)
+
+The cache is evicted every EVICT_INTERVAL jobs and on shutdown.
+
+For example:
+
+    $ curl -d '{"input": "paper.xhtml"}' http://127.0.0.1:8000/process
+"""
+
+# libraries
+import os
+import sys
+import json
+import signal
+import time
+import threading
+import socketserver
+import multiprocessing
+from pathlib import Path
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from .config import VERSION
+from .pipeline import get_pipeline, process_file, output_files
+
+# use logger
+from logging import getLogger
+logger = getLogger('postprocess')
+
+# the number of the jobs between the evictions of the cache
+EVICT_INTERVAL = 100
+
+
+# the module
+def run_job(job):
+    """Process a job in a worker.
+
+    Args:
+        job (tuple): (fn, out_dir, remove_pos, cache, compress)
+
+    Returns:
+        The response (dict) of the job.
+    """
+    fn, out_dir, remove_pos, cache, compress = job
+    start = time.perf_counter()
+    response = {
+        'input': str(fn),
+        'outputs': {
+            kind: str(path)
+            for kind, path in output_files(fn, out_dir, compress).items()
+        },
+        'stats': None
+    }
+
+    try:
+        doc = process_file(fn, out_dir, remove_pos, cache, compress=compress)
+        if doc is None:
+            response['status'] = 'skipped'
+        else:
+            response['status'] = 'done'
+            response['stats'] = doc.stats.to_dict()
+
+    except Exception as e:
+        logger.exception('Failed to process "{}"'.format(fn))
+        response['status'] = 'failed'
+        response['error'] = '{}: {}'.format(type(e).__name__, e)
+
+    response['elapsed'] = time.perf_counter() - start
+    return response
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """Handle the requests to the server."""
+
+    server_version = 'postprocess/' + VERSION.split()[-1]
+
+    def do_GET(self):
+        if self.path != '/status':
+            self.__send(404, {'error': 'Not found: {}'.format(self.path)})
+            return
+
+        self.__send(200, {'version': VERSION, 'workers': self.server.workers})
+
+    def do_POST(self):
+        if self.path != '/process':
+            self.__send(404, {'error': 'Not found: {}'.format(self.path)})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            fn = Path(request['input'])
+            out_dir = Path(request.get('out') or self.server.out_dir)
+            remove_pos = not request.get('map', False)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self.__send(400, {'error': 'Bad request: {}'.format(e)})
+            return
+
+        job = (fn, out_dir, remove_pos, self.server.cache,
+               self.server.compress)
+        self.__send(200, self.server.pool.apply(run_job, (job, )))
+        evict_cache(self.server)
+
+    def address_string(self):
+        # the client of a UNIX socket has no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, format, *args):
+        logger.debug('{} - {}'.format(self.address_string(), format % args))
+
+    def __send(self, code, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class Server(socketserver.ThreadingMixIn, HTTPServer):
+    """The HTTP server on localhost."""
+
+    daemon_threads = True
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """The HTTP server on a UNIX socket."""
+
+    daemon_threads = True
+
+    def server_bind(self):
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+def evict_cache(server, done=True):
+    """Count a job done, and evict the cache every EVICT_INTERVAL jobs.
+
+    Args:
+        server: The server
+        done (bool): Whether a job is done; False to evict now, e.g., on
+            shutdown
+    """
+    if server.cache is None:
+        return
+
+    with server.lock:
+        if done:
+            server.n_jobs += 1
+            if server.n_jobs % EVICT_INTERVAL:
+                return
+
+        server.cache.evict(server.cache_size, server.cache_age)
+
+
+def serve(out_dir,
+          host='127.0.0.1',
+          port=8000,
+          socket=None,
+          workers=1,
+          cache=None,
+          compress=None,
+          cache_size=None,
+          cache_age=None):
+    """Serve the jobs until interrupted.
+
+    Args:
+        out_dir (Path): The default output directory
+        host (str): The host to listen on
+        port (int): The port to listen on
+        socket (str): Listen on the UNIX socket instead of host and port
+        workers (int): The number of the worker processes
+        cache (ResultCache): The result cache, or None to disable it
+        compress (str): The compression method of the results, or None
+        cache_size (float): Evict the least recently used results when the
+            cache exceeds cache_size bytes
+        cache_age (float): Evict the results unused for cache_age seconds
+    """
+    # load the stages and the model once; the workers inherit them
+    get_pipeline()
+
+    # fork keeps the logger settings and the loaded model in the workers
+    ctx = multiprocessing.get_context('fork')
+    pool = ctx.Pool(workers)
+
+    if socket is not None:
+        if os.path.exists(socket):
+            os.unlink(socket)
+        server = UnixServer(socket, RequestHandler)
+        address = socket
+    else:
+        server = Server((host, port), RequestHandler)
+        address = 'http://{}:{}'.format(host, port)
+
+    server.pool = pool
+    server.workers = workers
+    server.out_dir = out_dir
+    server.cache = cache
+    server.compress = compress
+    server.cache_size = cache_size
+    server.cache_age = cache_age
+    server.n_jobs = 0
+    server.lock = threading.Lock()
+
+    # stop on SIGTERM as well as on SIGINT
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    logger.info('Serving on {} with {} workers'.format(address, workers))
+    try:
+        server.serve_forever()
+
+    except (KeyboardInterrupt, SystemExit):
+        logger.info('Shutting down the server')
+
+    finally:
+        server.server_close()
+        server.pool.terminate()
+        server.pool.join()
+        evict_cache(server, done=False)
+        if socket is not None and os.path.exists(socket):
+            os.unlink(socket)
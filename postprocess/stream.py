@@ -0,0 +1,168 @@
+"""
+The streaming loader for very large XHTML.
+
+Document parses the whole XHTML into a tree, which is kept until the results
+are written. StreamDocument instead reads the sections (body/div) one by one
+with iterparse: the stages run on each section, and the section is written
+into the output XHTML and removed from the tree once its paragraphs are
+closed. Only the head and the sections in process are kept in the tree.
+
+The stages need some state of the whole document, i.e., the figures for
+FigureTagger, the fonts for MathTagger, the references for CiteDetector and
+the continued paragraphs for Textualizer. The state is collected by a first
+pass over the file, which releases each section as soon as it is read.
+
+The results are the same as those of Pipeline.run, except that MathTagger
+tags each section as a sequence of its own, so the math tags near the
+boundaries of the sections may differ.
+
+Use Pipeline.run_stream to process a StreamDocument.
+"""
+
+# libraries
+import shutil
+from uuid import uuid4
+from tempfile import TemporaryFile
+from lxml import etree
+
+from .structures import (XHTML, Document, Layout, find_docid,
+                         parser_options)
+from .instrument import Stats
+from .compression import detect, open_file
+
+
+# the module
+class StreamDocument(Document):
+    """A document which is read section by section.
+
+    While the stages run on a section, 'tree' holds the head and the sections
+    not released yet, and 'layout' has only the section. The output XHTML is
+    written into a temporary file as the sections are released, and write()
+    copies it.
+    """
+
+    def __init__(self, fn):
+        """Initialize the document; the file is read by sections().
+
+        Args:
+            fn (str): The input file
+        """
+        self.filename = fn
+        self.stats = Stats()
+        self.tree = None
+        self.ids = None
+        self.layout_cache = None
+        self.docid_cache = None
+        self.output = None
+        self.body = None
+        self.marker = None
+
+    def sections(self):
+        """Read the sections of the document one by one.
+
+        For each section, the layout is set to the section, and its
+        SectionNode is yielded. The section is kept in the tree until it is
+        released by discard() or release(). Compressed files are
+        decompressed as a stream.
+        """
+        method = detect(self.filename)
+        f = None if method is None else open_file(self.filename, 'rb', method)
+        events = etree.iterparse(
+            f or self.filename, tag=XHTML + 'div', **parser_options())
+        try:
+            while True:
+                with self.stats.stage('parse'):
+                    _, node = next(events, (None, None))
+                if node is None:
+                    break
+
+                # only body/div is a section
+                body = node.getparent()
+                if (body is None or body.tag != XHTML + 'body'
+                        or body.getparent() is None
+                        or body.getparent().getparent() is not None):
+                    continue
+
+                self.tree = node.getroottree()
+                self.ids = None
+                self.layout_cache = Layout()
+                yield self.layout_cache.add_section(node)
+
+        finally:
+            if f is not None:
+                f.close()
+
+        self.tree = events.root.getroottree()
+        self.layout_cache = None
+
+    def discard(self, node):
+        """Remove the section from the tree without writing it."""
+        node.clear()
+        node.getparent().remove(node)
+
+    def release(self, node):
+        """Write the section, and the elements before it, into the output
+        XHTML, and remove them from the tree.
+
+        The sections must be released in document order.
+        """
+        body = node.getparent()
+        if self.output is None:
+            self.output = TemporaryFile()
+            self.body = body
+            self.marker = etree.Comment(uuid4().hex)
+            self.output.write(self.__serialize()[0])
+
+        # the namespaces are declared on the wrapper, as on the body
+        wrapper = etree.Element(body.tag, nsmap=body.nsmap)
+        while True:
+            e = body[0]
+            wrapper.append(e)
+            if e is node:
+                break
+
+        data = etree.tostring(wrapper)
+        self.output.write(data[data.index(b'>') + 1:data.rindex(b'</')])
+
+    def close(self):
+        """Write the rest of the tree into the output XHTML.
+
+        Call this after all sections are read and released.
+        """
+        if self.output is None:
+            self.output = TemporaryFile()
+            self.tree.write(self.output)
+        else:
+            self.output.write(self.__serialize()[1])
+
+        # the docid is kept for the outputs
+        self.docid_cache = find_docid(self.tree)
+        self.tree = None
+        self.ids = None
+        self.body = None
+
+    def __serialize(self):
+        """Serialize the tree, and split it before the first element in
+        the body.
+
+        Returns:
+            A tuple (before, after) of the bytes.
+        """
+        self.body.insert(0, self.marker)
+        data = etree.tostring(self.tree)
+        self.body.remove(self.marker)
+
+        return tuple(data.split(etree.tostring(self.marker), 1))
+
+    def write(self, f):
+        """Copy the output XHTML to the file.
+
+        Args:
+            f: A filename or a binary file object.
+        """
+        self.output.seek(0)
+        if isinstance(f, str):
+            with open(f, 'wb') as fp:
+                shutil.copyfileobj(self.output, fp)
+        else:
+            shutil.copyfileobj(self.output, f)
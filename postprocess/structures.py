@@ -3,11 +3,51 @@ The basic structures of texts.
 """
 
 # libraries
+import threading
+from array import array
 from lxml import etree
 
+from .instrument import Stats
+from .compression import detect, open_file
+
+# the namespace of the elements
+XHTML = '{http://www.w3.org/1999/xhtml}'
+
+# the options of the XML parsers, selectable by name:
+#   default: the default parser of lxml
+#   tuned:   no DTD nor network access, no index of the ids (we index the
+#            ids by ourselves), and no limit on the size of text nodes
+#   compact: tuned, and the whitespaces between the elements are removed;
+#            note that they are removed from the output XHTML as well
+PARSER_OPTIONS = {
+    'default': None,
+    'tuned': {
+        'load_dtd': False,
+        'no_network': True,
+        'collect_ids': False,
+        'huge_tree': True,
+    },
+    'compact': {
+        'load_dtd': False,
+        'no_network': True,
+        'collect_ids': False,
+        'huge_tree': True,
+        'remove_blank_text': True,
+    },
+}
+
+# the name of the parser used by the documents in the process
+parser_name = 'tuned'
+
+# the parsers reused in each thread, as a parser can not be shared by threads
+parser_pool = threading.local()
+
 
 # the module
 class Paragraph:
+    __slots__ = ('sec_id', '_id', 'sec_name', 'box_name', 'words',
+                 'backup_words')
+
     def __init__(self, sec_id, _id, sec_name, box_name, words, backup_words):
         self.sec_id = sec_id
         self._id = _id
@@ -16,16 +56,31 @@ class Paragraph:
         self.words = words
         self.backup_words = backup_words
 
+    @property
+    def text(self):
+        """The text of the words, with the spaces between them."""
+        return ''.join([w.space + w.text for w in self.words])
+
 
 class Word:
-    def __init__(self, _id, text, node=None, start=None):
+    """A word in a paragraph.
+
+    The space before the word is kept in 'space' ('' or ' ') instead of a
+    separate word, and 'start' is the position of the text, after the space.
+    """
+    __slots__ = ('_id', 'text', 'node', 'start', 'space')
+
+    def __init__(self, _id, text, node=None, start=None, space=''):
         self._id = _id
         self.text = text
         self.node = node
         self.start = start
+        self.space = space
 
 
 class Sentence:
+    __slots__ = ('_id', 'sec_name', 'box_name', 'text', 'words')
+
     def __init__(self, _id, sec_name, box_name, text, words):
         self._id = _id
         self.sec_name = sec_name
@@ -34,7 +89,313 @@ class Sentence:
         self.words = words
 
 
+class WordTable:
+    """The words of a document in columns, ordered by the positions.
+
+    Iterating the table yields (id, from, to) of the words.
+
+    Attributes:
+        ids (list): The ids of the words
+        starts (array): The start positions (data-from)
+        ends (array): The end positions (data-to)
+        sentences (array): The indices of the sentences of the words in
+            Document.sentences, or -1
+        ordered (bool): Whether the rows are sorted by the positions
+    """
+
+    def __init__(self):
+        self.ids = []
+        self.starts = array('q')
+        self.ends = array('q')
+        self.sentences = array('q')
+        self.ordered = True
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return zip(self.ids, self.starts, self.ends)
+
+    def append(self, _id, start, end, sentence=-1):
+        """Append a word."""
+        if self.ids and (start, end) < (self.starts[-1], self.ends[-1]):
+            self.ordered = False
+
+        self.ids.append(_id)
+        self.starts.append(start)
+        self.ends.append(end)
+        self.sentences.append(sentence)
+
+    def extend(self, table):
+        """Append the words in the other table."""
+        if self.ids and table.ids and (table.starts[0], table.ends[0]) < (
+                self.starts[-1], self.ends[-1]):
+            self.ordered = False
+        self.ordered = self.ordered and table.ordered
+
+        self.ids.extend(table.ids)
+        self.starts.extend(table.starts)
+        self.ends.extend(table.ends)
+        self.sentences.extend(table.sentences)
+
+    def sort(self):
+        """Sort the words by the positions; the order of ties is kept."""
+        if self.ordered:
+            return
+
+        order = sorted(
+            range(len(self.ids)), key=lambda i: (self.starts[i], self.ends[i]))
+        self.ids = [self.ids[i] for i in order]
+        self.starts = array('q', [self.starts[i] for i in order])
+        self.ends = array('q', [self.ends[i] for i in order])
+        self.sentences = array('q', [self.sentences[i] for i in order])
+        self.ordered = True
+
+
+class SectionNode:
+    """A section (body/div) in the tree."""
+
+    def __init__(self, node):
+        self.node = node
+        self._id = node.get('id')
+        self.name = node.get('data-name')
+        self.boxes = []
+
+
+class BoxNode:
+    """A box (body/div/div) in the tree."""
+
+    def __init__(self, node, section):
+        self.node = node
+        self.section = section
+        self.name = node.get('data-name')
+        self.paragraphs = []
+
+
+class ParagraphNode:
+    """A paragraph (body/div/div/p) in the tree, with its word spans."""
+
+    def __init__(self, node, box):
+        self.node = node
+        self.box = box
+        self._id = node.get('id')
+        self.spans = []
+        self.token_index = None
+
+    def find_spans(self, text):
+        """Find the spans whose text is equal to 'text'.
+
+        The token index of the paragraph is built on the first call, so that
+        the taggers can jump to the candidates when aligning phrases to spans.
+
+        Returns:
+            The ascending list of the positions in self.spans.
+        """
+        if self.token_index is None:
+            self.token_index = {}
+            for i, span in enumerate(self.spans):
+                if span.text is not None:
+                    self.token_index.setdefault(span.text, []).append(i)
+
+        return self.token_index.get(text, [])
+
+
+class Layout:
+    """The structural view of a document: sections, boxes, paragraphs and spans.
+
+    It is built with a single walk over 'x:body/x:div/x:div/x:p/x:span', and
+    the elements are listed in document order. The attributes of the elements
+    are not copied except ids and names, so the stages may change them freely.
+    """
+
+    def __init__(self, tree=None):
+        """Build the layout of the tree.
+
+        Args:
+            tree: The tree, or None to start with no sections and add them
+                with add_section.
+        """
+        self.sections = []
+        self.boxes = []
+        self.paragraphs = []
+        self.spans = []
+
+        if tree is None:
+            return
+
+        root = tree.getroot()
+        for body in root.iterchildren(XHTML + 'body'):
+            for sec in body.iterchildren(XHTML + 'div'):
+                self.add_section(sec)
+
+    def add_section(self, sec):
+        """Add a section (body/div) at the end.
+
+        Returns:
+            The SectionNode of the section.
+        """
+        section = SectionNode(sec)
+        self.sections.append(section)
+
+        for b in sec.iterchildren(XHTML + 'div'):
+            box = BoxNode(b, section)
+            section.boxes.append(box)
+            self.boxes.append(box)
+
+            for p in b.iterchildren(XHTML + 'p'):
+                paragraph = ParagraphNode(p, box)
+                box.paragraphs.append(paragraph)
+                self.paragraphs.append(paragraph)
+
+                paragraph.spans = list(p.iterchildren(XHTML + 'span'))
+                self.spans.extend(paragraph.spans)
+
+        return section
+
+
+def set_parser(name):
+    """Set the parser used by the documents in the process.
+
+    Call this before forking worker processes so that they inherit it.
+
+    Args:
+        name (str): The name of the parser in PARSER_OPTIONS
+    """
+    global parser_name
+
+    if name not in PARSER_OPTIONS:
+        raise ValueError('Unknown parser: {}'.format(name))
+
+    parser_name = name
+
+
+def get_parser(name=None):
+    """Get the XMLParser of the current thread.
+
+    The parser is created on the first call in each thread, and reused.
+
+    Args:
+        name (str): The name of the parser, or None for the parser set by
+            set_parser
+
+    Returns:
+        The XMLParser, or None for the default parser of lxml.
+    """
+    name = name or parser_name
+    options = PARSER_OPTIONS[name]
+    if options is None:
+        return None
+
+    parsers = parser_pool.__dict__
+    if name not in parsers:
+        parsers[name] = etree.XMLParser(**options)
+
+    return parsers[name]
+
+
+def parser_options(name=None):
+    """Get the options of the parser as keyword arguments, e.g., for iterparse.
+
+    Args:
+        name (str): The name of the parser, or None for the parser set by
+            set_parser
+    """
+    return PARSER_OPTIONS[name or parser_name] or {}
+
+
+def find_docid(tree):
+    """Find the docid in head/meta of the tree.
+
+    Returns:
+        The docid, or None if not defined.
+    """
+    meta = tree.find('{0}head/{0}meta[@docid]'.format(XHTML))
+    if meta is None:
+        return None
+
+    return meta.get('docid')
+
+
 class Document:
     def __init__(self, fn, parser=None):
+        """Parse the XHTML.
+
+        The files compressed with gzip, xz or zstd are decompressed as a
+        stream into the parser.
+
+        Args:
+            fn: A filename or a binary file object
+            parser (XMLParser): The parser, or None to use get_parser()
+        """
         self.filename = fn
-        self.tree = etree.parse(fn, parser=parser)
+        self.stats = Stats()
+        if parser is None:
+            parser = get_parser()
+        with self.stats.stage('parse'):
+            method = detect(fn) if isinstance(fn, str) else None
+            if method is None:
+                self.tree = etree.parse(fn, parser=parser)
+            else:
+                with open_file(fn, 'rb', method) as f:
+                    self.tree = etree.parse(f, parser=parser)
+        self.ids = None
+        self.layout_cache = None
+        self.docid_cache = None
+
+    @property
+    def layout(self):
+        """The structural view of the document (Layout).
+
+        It is built on the first access and shared by all stages.
+        """
+        if self.layout_cache is None:
+            self.layout_cache = Layout(self.tree)
+
+        return self.layout_cache
+
+    @property
+    def docid(self):
+        """The docid in head/meta of the document, or None if not defined."""
+        if self.docid_cache is None and self.tree is not None:
+            self.docid_cache = find_docid(self.tree)
+
+        return self.docid_cache
+
+    def write(self, f):
+        """Serialize the tree to the file.
+
+        The XHTML is written incrementally, without building the whole
+        serialization in memory. The output is the same as
+        etree.tostring(self.tree).
+
+        Args:
+            f: A filename or a binary file object.
+        """
+        self.tree.write(f)
+
+    def invalidate(self):
+        """Drop the id index and the layout.
+
+        Stages which add, remove or move elements must call this, so that
+        the indexes are rebuilt from the modified tree.
+        """
+        self.ids = None
+        self.layout_cache = None
+
+    def get_element_by_id(self, _id):
+        """Get the element whose id attribute is equal to '_id'.
+
+        The id index is built on the first call, with a single walk over the
+        tree. If the ids are duplicated, the first element wins.
+
+        Returns:
+            The element, or None if not found.
+        """
+        if self.ids is None:
+            self.ids = {}
+            for e in self.tree.iter(etree.Element):
+                key = e.get('id')
+                if key is not None and key not in self.ids:
+                    self.ids[key] = e
+
+        return self.ids.get(_id)
@@ -4,8 +4,9 @@ The Textualizer module.
 
 # libraries
 import re
+from collections import deque
 from nltk.tokenize.punkt import PunktSentenceTokenizer, PunktParameters
-from .structures import Paragraph, Word, Sentence
+from .structures import XHTML, Paragraph, Word, Sentence, WordTable
 
 # use logger
 from logging import getLogger
@@ -37,7 +38,7 @@ class Textualizer:
         Returns:
             A list of sentences.
         """
-        text = ''.join([w.text for w in par.words])
+        text = par.text
 
         word_iter = iter(par.words)
         word = next(word_iter)
@@ -85,222 +86,373 @@ class Textualizer:
             doc (Document): The input document
             remove_pos (bool): Whether remove positions or not
         """
+        builder = TextBuilder(self, doc.stats)
+        for sec in doc.layout.sections:
+            builder.add_section(sec)
 
-        # basic variables
-        ligatures = {
-            '\ufb00': 'ff',
-            '\ufb01': 'fi',
-            '\ufb02': 'fl',
-            '\ufb03': 'ffi',
-            '\ufb04': 'ffl',
-            '\ufb05': 'st',
-            '\ufb06': 'st',
-        }
-        ns = {'x': 'http://www.w3.org/1999/xhtml'}
-        end_token = re.compile(r'[?!.]$')
-        tag_token = re.compile(r'(?<!\s)-$')
-
-        pars = {}
-        par_ls = []
-        last_par = None
-        ref_pars = []
-        cite = None
-        math = None
-        ignore_math = False
-        math_ls = []
-        word_nodes = {}
-        cites = {}
-
-        for sec in doc.tree.xpath('x:body/x:div', namespaces=ns):
-            sec_id = sec.get('id')
-            sec_name = sec.get('data-name')
-
-            for box in sec.xpath('x:div', namespaces=ns):
-                box_name = box.get('data-name')
-
-                for par in box.xpath('x:p', namespaces=ns):
-                    math_par = False
-                    par_id = par.get('id')
-                    page_id = int(par.get('data-page'))
-
-                    # standalone equations should continue from last par
-                    if box_name == 'Equation' and last_par:
-                        p = pars[last_par]
-                        # TODO: a bit different from the original; please check
-                        # print(len(p.words))
-
-                        if not end_token.match(p.words[-1].text):
-                            continued_from_id = last_par
-                            math_par = True
+        builder.close(final=True)
+        builder.flush(doc.layout.spans)
+        builder.finish(doc)
 
-                    else:
-                        continued_from_id = par.get('data-continued-from')
-
-                    # if not continued_from_id or par_ls:
-                    #    text = '\n\n'
-                    #    par_ls[-1].words.append(Word(None, text))
-
-                    if not continued_from_id and box_name == 'Reference':
-                        ref_pars.append(par_id)
+        # scrub the tree; remove positions
+        if remove_pos:
+            self.remove_positions(doc.tree.getroot())
+
+    @staticmethod
+    def remove_positions(node):
+        """Remove the positions (data-from) of the words under the node."""
+        for w in node.iter(XHTML + 'span'):
+            if w.get('class', None) == 'word':
+                w.attrib.pop('data-from', None)
+
+
+class TextBuilder:
+    """The state of textualizing a document.
+
+    The sections are added in order, and the paragraphs are closed in order:
+    the positions and the sentences of a paragraph are fixed when it is
+    closed. Textualizer.textualize adds all sections and closes all
+    paragraphs at once, while the streaming loader closes the paragraphs
+    which no later paragraph continues, and releases their sections.
+    """
+
+    ligatures = {
+        '\ufb00': 'ff',
+        '\ufb01': 'fi',
+        '\ufb02': 'fl',
+        '\ufb03': 'ffi',
+        '\ufb04': 'ffl',
+        '\ufb05': 'st',
+        '\ufb06': 'st',
+    }
+    end_token = re.compile(r'[?!.]$')
+    tag_token = re.compile(r'(?<!\s)-$')
+
+    def __init__(self, textualizer, stats, continued=None):
+        """Initialize the state.
 
-                    nodes = list(par)
-                    tmp_ref = nodes[0].get('data-refid', False)
-                    tmp_ref = nodes[0].get('data-refid', False)
-                    if tmp_ref and tmp_ref != nodes[0].get('id'):
-                        del nodes[0]
+        Args:
+            textualizer (Textualizer): The textualizer to find sentences
+            stats (Stats): The stats of the document
+            continued (dict): The index of the last paragraph which continues
+                each paragraph id (data-continued-from), counted in document
+                order. If None, no paragraph is closed until the end.
+        """
+        self.textualizer = textualizer
+        self.stats = stats
+        self.continued = continued
+
+        # the state carried over paragraphs
+        self.pars = {}
+        self.open_pars = deque()
+        self.open_until = {}
+        self.aliases = {}
+        self.indexes = {}
+        self.n_pars = 0
+        self.n_created = 0
+        self.n_closed = 0
+        self.last_par = None
+        self.continued_from_id = None
+        self.ref_pars = []
+        self.cite = None
+        self.math = None
+        self.ignore_math = False
+        self.word_nodes = {}
+        self.cites = {}
+
+        # the results
+        self.par_pos = 0
+        self.texts = []
+        self.ref_texts = {}
+        self.maths = []
+        self.sentences = []
+        self.sent_index = {}
+        self.positions = WordTable()
+        self.positioned = set()
+        self.unpositioned = WordTable()
+
+    def add_section(self, sec):
+        """Add the words of a section (SectionNode).
 
-                    if continued_from_id:
-                        par = pars[continued_from_id]
+        Returns:
+            The index of the last paragraph which has the words of the
+            section (-1 if none); the section can be released after the
+            paragraphs up to it are closed.
+        """
+        end_token = self.end_token
+        tag_token = self.tag_token
+        ligatures = self.ligatures
+
+        pars = self.pars
+        word_nodes = self.word_nodes
+        last = -1
+
+        sec_id = sec._id
+        sec_name = sec.name
+
+        for box in sec.boxes:
+            box_name = box.name
+
+            for par in (p.node for p in box.paragraphs):
+                math_par = False
+                par_id = par.get('id')
+                page_id = int(par.get('data-page'))
+
+                # standalone equations should continue from last par
+                if box_name == 'Equation' and self.last_par:
+                    p = pars[self.last_par]
+                    # TODO: a bit different from the original; please check
+                    # print(len(p.words))
+
+                    if not end_token.match(p.words[-1].text):
+                        self.continued_from_id = self.last_par
+                        math_par = True
+
+                else:
+                    self.continued_from_id = par.get('data-continued-from')
+                continued_from_id = self.continued_from_id
+
+                # if not continued_from_id or par_ls:
+                #    text = '\n\n'
+                #    par_ls[-1].words.append(Word(None, text))
+
+                if not continued_from_id and box_name == 'Reference':
+                    self.ref_pars.append(par_id)
+
+                nodes = list(par)
+                tmp_ref = nodes[0].get('data-refid', False)
+                tmp_ref = nodes[0].get('data-refid', False)
+                if tmp_ref and tmp_ref != nodes[0].get('id'):
+                    del nodes[0]
+
+                if continued_from_id:
+                    par = pars[continued_from_id]
+                else:
+                    par = Paragraph(sec_id, par_id, sec_name, box_name, [],
+                                    [])
+                    self.open_pars.append(par)
+                    self.aliases[par_id] = []
+                    self.indexes[par_id] = self.n_created
+                    self.n_created += 1
+
+                pars[par_id] = par
+                self.aliases[par._id].append(par_id)
+                if self.continued is not None:
+                    self.open_until[par._id] = max(
+                        self.open_until.get(par._id, -1),
+                        self.continued.get(par_id, -1))
+                self.n_pars += 1
+                last = max(last, self.indexes[par._id])
+
+                for node in filter(
+                        lambda n: n.get(
+                            'data-refid') is None or n.get('id') == n.get('data-refid'),
+                        nodes):
+
+                    sp_val = node.get('data-space')
+                    if sp_val == 'nospace' or (
+                            sp_val == 'bol' and
+                        (not par.words
+                         or tag_token.search(par.words[-1].text))):
+                        space = ''
                     else:
-                        par = Paragraph(sec_id, par_id, sec_name, box_name, [],
-                                        [])
-                        par_ls.append(par)
-
-                    pars[par_id] = par
-
-                    for node in filter(
-                            lambda n: n.get(
-                                'data-refid') is None or n.get('id') == n.get('data-refid'),
-                            nodes):
-
-                        sp_val = node.get('data-space')
-                        if sp_val == 'nospace' or (
-                                sp_val == 'bol' and
-                            (not par.words
-                             or tag_token.search(par.words[-1].text))):
-                            space = None
+                        space = ' '
+
+                    text = node.get('data-fullform') or node.text or ''
+
+                    text = re.sub(r'\s+', ' ', text)
+                    text = ''.join([
+                        ligatures[c] if ligatures.get(c, False) else c
+                        for c in text
+                    ])
+
+                    _id = node.get('id')
+                    word_nodes[_id] = node
+
+                    # inside a citation; skip everything
+                    if self.cite:
+                        self.math = None
+                        space = ''
+                        word = Word(_id, '')
+                        if self.cite == node.get('id'):
+                            self.cite = None
+
+                    # starting a citation; make a dummy word
+                    elif node.get('data-cite-end', False):
+                        if self.math:
+                            par.words = par.backup_words
+                            self.math = None
+                            self.ignore_math = True
+
+                        self.cite = node.get('data-cite-end')
+                        cids = node.get('data-cite-id').split(',')
+                        text = ', '.join(map(lambda c: 'CITE-' + c, cids))
+                        self.cites.update({c: _id for c in cids})
+                        word = Word(_id, text)
+
+                    # starting an equation
+                    elif not self.ignore_math and (
+                            node.get('data-math') == 'B-Math' or
+                        (node.get('data-math') == 'I-Math' and not self.math)
+                            or (math_par and not self.math)):
+                        par.backup_words = par.words.copy()
+                        par.backup_words.append(
+                            Word(_id, text, node, space=space))
+
+                        if math_par:
+                            mid = 'MATH-' + par_id
                         else:
-                            space = Word(None, ' ')
-
-                        text = node.get('data-fullform') or node.text or ''
-
-                        text = re.sub(r'\s+', ' ', text)
-                        text = ''.join([
-                            ligatures[c] if ligatures.get(c, False) else c
-                            for c in text
-                        ])
-
-                        _id = node.get('id')
-                        word_nodes[_id] = node
-
-                        # inside a citation; skip everything
-                        if cite:
-                            math = None
-                            space = None
-                            word = Word(_id, '')
-                            if cite == node.get('id'):
-                                cite = None
-
-                        # starting a citation; make a dummy word
-                        elif node.get('data-cite-end', False):
-                            if math:
-                                par.words = par.backup_words
-                                math = None
-                                ignore_math = True
-
-                            cite = node.get('data-cite-end')
-                            cids = node.get('data-cite-id').split(',')
-                            text = ', '.join(map(lambda c: 'CITE-' + c, cids))
-                            cites.update({c: _id for c in cids})
-                            word = Word(_id, text)
-
-                        # starting an equation
-                        elif not ignore_math and (
-                                node.get('data-math') == 'B-Math' or
-                            (node.get('data-math') == 'I-Math' and not math) or
-                                (math_par and not math)):
-                            par.backup_words = par.words.copy()
-                            if space:
-                                par.backup_words.append(space)
-                            par.backup_words.append(Word(_id, text, node))
-
-                            if math_par:
-                                mid = 'MATH-' + par_id
-                            else:
-                                mid = 'MATH-' + _id
-                            word = Word(_id, mid)
-                            math = [mid, _id, _id, page_id] + [
-                                float(a)
-                                for a in node.get('data-bdr').split(',')
-                            ]
-                            math_ls.append(math)
-
-                        # inside an equation: skip while calculating bbox
-                        elif not ignore_math and (
-                                node.get('data-math') == 'I-Math' or math_par):
-                            if space:
-                                par.backup_words.append(space)
-                            par.backup_words.append(Word(_id, text, node))
-
-                            space = None
-                            word = Word(_id, '')
-                            math[2] = _id
-                            new = [
-                                float(a)
-                                for a in node.get('data-bdr').split(',')
-                            ]
-                            math[4] = min(math[4], new[0])
-                            math[5] = min(math[5], new[1])
-                            math[6] = max(math[6], new[2])
-                            math[7] = max(math[7], new[3])
-
-                        # normal texts
-                        else:
-                            math = None
-                            ignore_math = False
-                            word = Word(_id, text, node)
-
-                        # finish the loop
-                        if space is not None:
-                            par.words.append(space)
-                        if word is not None:
-                            par.words.append(word)
-
-                    # set last_par
-                    if box_name != 'Body':
-                        last_par = None
-                    elif continued_from_id:
-                        last_par = continued_from_id
+                            mid = 'MATH-' + _id
+                        word = Word(_id, mid)
+                        self.math = [mid, _id, _id, page_id] + [
+                            float(a)
+                            for a in node.get('data-bdr').split(',')
+                        ]
+                        self.maths.append(self.math)
+
+                    # inside an equation: skip while calculating bbox
+                    elif not self.ignore_math and (
+                            node.get('data-math') == 'I-Math' or math_par):
+                        par.backup_words.append(
+                            Word(_id, text, node, space=space))
+
+                        space = ''
+                        word = Word(_id, '')
+                        math = self.math
+                        math[2] = _id
+                        new = [
+                            float(a)
+                            for a in node.get('data-bdr').split(',')
+                        ]
+                        math[4] = min(math[4], new[0])
+                        math[5] = min(math[5], new[1])
+                        math[6] = max(math[6], new[2])
+                        math[7] = max(math[7], new[3])
+
+                    # normal texts
                     else:
-                        last_par = par_id
-
-        par_pos = 0
-        for p in par_ls:
-            p.words.append(Word(None, '\n\n'))
-            pos = 0
-            for w in p.words:
-                w.start = pos
-                next_pos = pos + len(w.text)
-                if w.node is not None:
-                    w.node.set('data-from', str(par_pos + pos))
-                    w.node.set('data-to', str(par_pos + next_pos))
-                pos = next_pos
-            par_pos += pos
+                        self.math = None
+                        self.ignore_math = False
+                        word = Word(_id, text, node)
+
+                    # finish the loop
+                    word.space = space
+                    par.words.append(word)
+
+                # set last_par
+                if box_name != 'Body':
+                    self.last_par = None
+                elif continued_from_id:
+                    self.last_par = continued_from_id
+                else:
+                    self.last_par = par_id
+
+        return last
+
+    def close(self, final=False):
+        """Close the paragraphs in order, as long as no later paragraph can
+        continue them.
+
+        Args:
+            final (bool): Close all paragraphs at the end of the document
+        """
+        while self.open_pars:
+            p = self.open_pars[0]
+            if not final and (
+                    self.continued is None
+                    or self.open_until[p._id] >= self.n_pars
+                    or (self.last_par and self.pars[self.last_par] is p)):
+                break
+
+            self.open_pars.popleft()
+            self.__close_paragraph(p)
+
+    def __close_paragraph(self, p):
+        """Fix the positions and the sentences of the paragraph."""
+
+        # the positions of the words are kept in the table in order
+        positions = self.positions
+        row = len(positions)
+        p.words.append(Word(None, '\n\n'))
+        pos = 0
+        for w in p.words:
+            pos += len(w.space)
+            w.start = pos
+            next_pos = pos + len(w.text)
+            if w.node is not None:
+                w.node.set('data-from', str(self.par_pos + pos))
+                w.node.set('data-to', str(self.par_pos + next_pos))
+                positions.append(w._id, self.par_pos + pos,
+                                 self.par_pos + next_pos)
+                self.positioned.add(w._id)
+            pos = next_pos
+        self.par_pos += pos
 
         # textualize
-        sent_ls = []
-        for p in par_ls:
-            sent_ls.extend(self.find_sentences(p))
+        with self.stats.stage('text.sentences'):
+            sent_ls = self.textualizer.find_sentences(p)
 
         for s in sent_ls:
+            i = len(self.sentences)
+            self.sentences.append(s)
             for w in s.words:
-                word_nodes[w].set('data-sent-id', str(s._id))
+                self.word_nodes[w].set('data-sent-id', str(s._id))
+                self.sent_index[w] = i
 
-        # collect the data
-        word_ls = [(w.get('id'), int(w.get('data-from', 0)),
-                    int(w.get('data-to', 0)))
-                   for w in doc.tree.xpath('//x:span', namespaces=ns)]
-        doc.words = sorted(word_ls, key=lambda w: (w[1], w[2]))
+        for i in range(row, len(positions)):
+            positions.sentences[i] = self.sent_index.get(positions.ids[i], -1)
 
-        doc.text = ''.join([w.text for p in par_ls for w in p.words])
-        doc.sentences = sent_ls
-        doc.maths = math_ls
-        doc.cites = [('CITE-' + p, ''.join([w.text
-                                            for w in pars[p].words]).strip(),
-                      cites.get(p, [])) for p in ref_pars]
+        text = p.text
+        self.texts.append(text)
+        if p.box_name == 'Reference':
+            self.ref_texts[p._id] = text.strip()
 
-        # scrub the tree; remove positions
-        if remove_pos:
-            for w in doc.tree.xpath('//x:span', namespaces=ns):
-                if w.get('class', None) == 'word':
-                    w.attrib.pop('data-from', None)
+        for par_id in self.aliases.pop(p._id):
+            del self.pars[par_id]
+        self.open_until.pop(p._id, None)
+        self.indexes.pop(p._id)
+        self.n_closed += 1
+
+    def flush(self, spans):
+        """Collect the words without positions (e.g., in maths and
+        citations) in the spans, and forget the spans.
+
+        Call this when the paragraphs which have the spans are closed.
+        """
+        with self.stats.stage('text.words'):
+            for w in spans:
+                _id = w.get('id')
+                if _id in self.positioned:
+                    self.positioned.discard(_id)
+                else:
+                    self.unpositioned.append(
+                        _id, int(w.get('data-from', 0)),
+                        int(w.get('data-to', 0)),
+                        self.sent_index.get(_id, -1))
+                self.sent_index.pop(_id, None)
+                self.word_nodes.pop(_id, None)
+
+    def finish(self, doc):
+        """Put the results into the document.
+
+        The words without positions come first, then the positioned words,
+        ordered by the positions.
+        """
+        with self.stats.stage('text.words'):
+            words = self.unpositioned
+            words.extend(self.positions)
+            words.sort()
+            doc.words = words
+
+        doc.text = ''.join(self.texts)
+        doc.sentences = self.sentences
+        doc.maths = self.maths
+        doc.cites = [('CITE-' + p, self.ref_texts[p], self.cites.get(p, []))
+                     for p in self.ref_pars]
+
+        stats = self.stats
+        stats.count('text.paragraphs', self.n_created)
+        stats.count('text.words', len(doc.words))
+        stats.count('text.sentences', len(self.sentences))
+        stats.count('text.maths', len(self.maths))
+        stats.count('text.cites', len(doc.cites))
@@ -7,6 +7,7 @@ setup(
     author='The PDFNLT Project Team',
     author_email='PDFNLT@nii.ac.jp',
     install_requires=['lxml', 'nltk', 'docopt', 'python-crfsuite', 'regex'],
+    extras_require={'zstd': ['zstandard']},
     url='https://github.com/KMCS-NII/postprocess',
     packages=find_packages(exclude=('tests', 'docs')),
     test_suite='tests')